@@ -0,0 +1,253 @@
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+import main as pipeline
+from encoders import select_encoder
+from file_watcher import FileWatcher
+from playlist_manager import PlaylistManager
+from probe_cache import ProbeCache
+from streaming_server import start_streaming_server
+from transcode_pool import TranscodePool
+from video_processing import SNAPSHOT_LOOP_SECONDS
+
+subprocess_counts = Counter()
+subprocess_lock = threading.Lock()
+OriginalPopen = subprocess.Popen
+
+class CountingPopen(OriginalPopen):
+    # subprocess.run goes through Popen as well, so this sees every process the pipeline starts.
+    def __init__(self, args, *popen_args, **popen_kwargs):
+        command = args[0] if isinstance(args, (list, tuple)) else str(args).split()[0]
+        with subprocess_lock:
+            subprocess_counts[os.path.basename(command)] += 1
+        super().__init__(args, *popen_args, **popen_kwargs)
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+def run_ffmpeg(args):
+    subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y', *args], check=True)
+
+def make_templates(template_dir, resolution, recording_seconds, placeholder_seconds):
+    snapshot_path = os.path.join(template_dir, 'snapshot.jpg')
+    recording_path = os.path.join(template_dir, 'recording.mp4')
+    placeholder_path = os.path.join(template_dir, 'placeholder.mp4')
+    run_ffmpeg(['-f', 'lavfi', '-i', f'testsrc2=size={resolution}', '-frames:v', '1', snapshot_path])
+    run_ffmpeg([
+        '-f', 'lavfi', '-i', f'testsrc2=size={resolution}:rate=30',
+        '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=44100',
+        '-t', str(recording_seconds),
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-shortest',
+        recording_path
+    ])
+    run_ffmpeg([
+        '-f', 'lavfi', '-i', 'testsrc2=size=1280x720:rate=24',
+        '-f', 'lavfi', '-i', 'anullsrc=channel_layout=mono:sample_rate=16000',
+        '-t', str(placeholder_seconds),
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-profile:v', 'high', '-pix_fmt', 'yuv420p',
+        '-g', '48', '-bf', '0',
+        '-c:a', 'aac', '-b:a', '32k', '-ar', '16000', '-ac', '1', '-shortest',
+        placeholder_path
+    ])
+    return {'Snapshot': snapshot_path, 'Recording': recording_path, 'placeholder': placeholder_path}
+
+def blink_path(watch_directory, timestamp, camera, kind):
+    day_directory = os.path.join(watch_directory, 'Snapshots', timestamp.strftime('%Y/%m-%B/%d'))
+    os.makedirs(day_directory, exist_ok=True)
+    extension = 'mp4' if kind == 'Recording' else 'jpg'
+    return os.path.join(day_directory, f"{timestamp.strftime('%H%M%S')}-Camera{camera}-{kind}.{extension}")
+
+def drop_files(options, watch_directory, templates, drop_times, finished):
+    rng = random.Random(options.seed)
+    counter = 0
+    for _ in range(options.bursts):
+        for _ in range(options.burst_size):
+            kind = 'Recording' if rng.random() < options.recording_ratio else 'Snapshot'
+            timestamp = datetime.now()
+            camera = counter % options.cameras + 1
+            file_path = blink_path(watch_directory, timestamp, camera, kind)
+            while os.path.exists(file_path):
+                camera += options.cameras
+                file_path = blink_path(watch_directory, timestamp, camera, kind)
+            drop_times[os.path.basename(file_path).replace('.jpg', '.mp4')] = time.monotonic()
+            shutil.copyfile(templates[kind], file_path)
+            counter += 1
+            time.sleep(1 / options.rate)
+        time.sleep(options.burst_interval)
+    finished.set()
+
+def timed(function, samples, frames_of):
+    def wrapper(*args, **kwargs):
+        start_time = time.monotonic()
+        result = function(*args, **kwargs)
+        samples.append((frames_of(*args), time.monotonic() - start_time))
+        return result
+    return wrapper
+
+def run_benchmark(options):
+    work_directory = options.work_dir or tempfile.mkdtemp(prefix='blink_benchmark_')
+    watch_directory = os.path.join(work_directory, 'watch')
+    temp_directory = os.path.join(work_directory, 'temp_videos')
+    template_directory = os.path.join(work_directory, 'templates')
+    for directory in (watch_directory, temp_directory, template_directory):
+        os.makedirs(directory, exist_ok=True)
+
+    print(f" - Generating synthetic Blink files in {work_directory}")
+    templates = make_templates(template_directory, options.resolution, options.recording_seconds, options.duration)
+    placeholder_path = os.path.join(temp_directory, 'placeholder.mp4')
+    shutil.copyfile(templates['placeholder'], placeholder_path)
+
+    encoder = select_encoder(options.encoder, options.vaapi_device)
+
+    subprocess.Popen = CountingPopen
+
+    encode_samples = []
+    queue_samples = []
+    latencies = []
+    drop_times = {}
+    finished_dropping = threading.Event()
+
+    pipeline.create_video_from_snapshot = timed(pipeline.create_video_from_snapshot, encode_samples, lambda *args: SNAPSHOT_LOOP_SECONDS * 24)
+    pipeline.reencode_video = timed(pipeline.reencode_video, encode_samples, lambda *args: args[2] * 24)
+
+    file_watcher = FileWatcher(watch_directory, options.duration, options.delay_minutes, temp_directory, ProbeCache())
+    scheduler_add = file_watcher.scheduler.add
+    def timed_add(*args, **kwargs):
+        start_time = time.monotonic()
+        added = scheduler_add(*args, **kwargs)
+        queue_samples.append(time.monotonic() - start_time)
+        return added
+    file_watcher.scheduler.add = timed_add
+
+    playlist_manager = PlaylistManager(temp_directory, temp_directory, placeholder_path, options.duration)
+    playlist_manager.initialize_playlists()
+    playlist_manager.current_index = 1
+    add_video_to_playlist = playlist_manager.add_video_to_playlist
+    def timed_add_video(video_path, *args, **kwargs):
+        drop_time = drop_times.get(os.path.basename(video_path))
+        if drop_time is not None:
+            latencies.append(time.monotonic() - drop_time)
+        return add_video_to_playlist(video_path, *args, **kwargs)
+    playlist_manager.add_video_to_playlist = timed_add_video
+
+    transcode_pool = TranscodePool(options.workers, on_finished=file_watcher.scheduler.wake)
+    file_watcher.start()
+
+    dropper = threading.Thread(target=drop_files, args=(options, watch_directory, templates, drop_times, finished_dropping), daemon=True)
+    start_time = time.monotonic()
+    dropper.start()
+
+    playlist_manager_thread = None
+    streaming_process = None
+    peak_backlog = 0
+    idle_since = None
+
+    try:
+        while time.monotonic() - start_time < options.timeout:
+            while True:
+                item = file_watcher.scheduler.pop_due(datetime.now())
+                if item is None:
+                    break
+                transcode_pool.submit(item[0], pipeline.process_queue_item, file_watcher, item, temp_directory, options.duration, encoder)
+
+            pipeline.deliver_finished_videos(transcode_pool, playlist_manager)
+
+            if options.sink and playlist_manager_thread is None and latencies:
+                playlist_manager_thread = threading.Thread(target=playlist_manager.run, daemon=True)
+                playlist_manager_thread.start()
+                playlist_manager.current_index = 0
+                playlist_manager.finished_processing_first_video()
+                streaming_process = start_streaming_server(playlist_manager.active_playlist, options.sink, 'mpegts')
+
+            backlog = len(file_watcher.scheduler) + transcode_pool.pending_count()
+            peak_backlog = max(peak_backlog, backlog)
+
+            if finished_dropping.is_set() and backlog == 0:
+                idle_since = idle_since or time.monotonic()
+                if time.monotonic() - idle_since >= options.settle:
+                    break
+            else:
+                idle_since = None
+
+            file_watcher.scheduler.wait(datetime.now(), timeout=0.25)
+    finally:
+        elapsed_time = time.monotonic() - start_time
+        file_watcher.stop()
+        transcode_pool.shutdown(wait=True)
+        playlist_manager.stop()
+        if streaming_process is not None:
+            streaming_process.terminate()
+            streaming_process.wait()
+        subprocess.Popen = OriginalPopen
+        if not options.keep and not options.work_dir:
+            shutil.rmtree(work_directory, ignore_errors=True)
+
+    total_frames = sum(frames for frames, _ in encode_samples)
+    total_encode_time = sum(encode_time for _, encode_time in encode_samples)
+    return {
+        'wall_seconds': round(elapsed_time, 3),
+        'files_dropped': len(drop_times),
+        'clips_delivered': len(latencies),
+        'latency_seconds': {
+            'p50': percentile(latencies, 0.50),
+            'p90': percentile(latencies, 0.90),
+            'p99': percentile(latencies, 0.99),
+            'max': max(latencies) if latencies else None,
+        },
+        'encodes': len(encode_samples),
+        'encode_fps': total_frames / total_encode_time if total_encode_time else None,
+        'ffprobe_processes': subprocess_counts['ffprobe'],
+        'subprocesses': dict(subprocess_counts),
+        'queue_maintenance_ms': {
+            'total': sum(queue_samples) * 1000,
+            'mean': sum(queue_samples) * 1000 / len(queue_samples) if queue_samples else None,
+            'max': max(queue_samples) * 1000 if queue_samples else None,
+        },
+        'peak_backlog': peak_backlog,
+    }
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark of the Blink streaming pipeline on synthetic files.")
+    parser.add_argument('--bursts', type=int, default=5, help="Number of bursts of files to drop")
+    parser.add_argument('--burst-size', type=int, default=4, help="Files dropped per burst")
+    parser.add_argument('--rate', type=float, default=4.0, help="Files per second within a burst")
+    parser.add_argument('--burst-interval', type=float, default=5.0, help="Seconds between bursts")
+    parser.add_argument('--recording-ratio', type=float, default=0.3, help="Fraction of files that are recordings")
+    parser.add_argument('--cameras', type=int, default=3, help="Number of cameras in the generated file names")
+    parser.add_argument('--recording-seconds', type=float, default=10, help="Length of generated recordings")
+    parser.add_argument('--resolution', default='1920x1080', help="Resolution of generated snapshots and recordings")
+    parser.add_argument('--duration', type=int, default=60, help="Snapshot duration budget, as in settings.json")
+    parser.add_argument('--delay-minutes', type=float, default=30, help="Delay window, as in settings.json")
+    parser.add_argument('--workers', type=int, default=2, help="Concurrent encodes")
+    parser.add_argument('--encoder', default='libx264-ultrafast', help="Encoder backend, or auto")
+    parser.add_argument('--vaapi-device', default='/dev/dri/renderD128')
+    parser.add_argument('--sink', help="Stream the playlist to this local file or udp:// URL instead of RTSP")
+    parser.add_argument('--settle', type=float, default=3.0, help="Seconds without backlog before the run ends")
+    parser.add_argument('--timeout', type=float, default=600, help="Upper bound on the run time in seconds")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work-dir', help="Directory for generated files (kept after the run)")
+    parser.add_argument('--keep', action='store_true', help="Keep the temporary work directory")
+    parser.add_argument('--json-output', help="Also write the report to this JSON file")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    options = parse_args()
+    report = run_benchmark(options)
+    print(json.dumps(report, indent=2))
+    if options.json_output:
+        with open(options.json_output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -1,20 +1,95 @@
 import os
-from datetime import datetime
+import threading
+import time
+from metrics import TEMP_DISK_BYTES
 
-def cleanup_temp_files(temp_directory, excluded_files, min_age_minutes=120):
-    current_time = datetime.now()
-    files_to_remove = []
+class TempFileEvictor:
+    # Keeps an index of the clips the pipeline wrote to the temp directory (size, creation
+    # time and when each one aired), so eviction never has to list or stat the directory.
+    # Clips still referenced by a playlist are never removed.
+    def __init__(self, temp_directory, excluded_files, min_age_minutes=120, max_bytes=0):
+        self.temp_directory = temp_directory
+        self.excluded_files = set(excluded_files)
+        self.min_age_minutes = min_age_minutes
+        self.max_bytes = max_bytes
+        self.clips = {}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
 
-    for filename in os.listdir(temp_directory):
-        file_path = os.path.join(temp_directory, filename)
-        if os.path.isfile(file_path) and file_path.endswith('.mp4') and filename not in excluded_files:
-            file_creation_time = datetime.fromtimestamp(os.path.getctime(file_path))
-            if (current_time - file_creation_time).total_seconds() > min_age_minutes * 60:
-                files_to_remove.append(file_path)
+    def adopt_existing(self):
+        # One scan at startup picks up clips left by the previous run.
+        try:
+            entries = os.scandir(self.temp_directory)
+        except OSError as e:
+            print(f"  - Error scanning temp directory {self.temp_directory}: {e}")
+            return
+        with entries:
+            for entry in entries:
+                if entry.name.endswith('.mp4') and entry.name not in self.excluded_files and entry.is_file():
+                    stat = entry.stat()
+                    self.add_clip(entry.name, stat.st_size, stat.st_mtime)
+        TEMP_DISK_BYTES.set(self.total_bytes)
+
+    def add_clip(self, filename, size, created_at):
+        with self.lock:
+            previous = self.clips.get(filename)
+            if previous is not None:
+                self.total_bytes -= previous['size']
+            self.clips[filename] = {'size': size, 'created_at': created_at, 'aired_at': None}
+            self.total_bytes += size
 
-    for file_path in files_to_remove:
+    def track(self, video_path):
+        filename = os.path.basename(video_path)
+        if filename in self.excluded_files:
+            return
         try:
-            os.remove(file_path)
-            print(f" - Removed old temporary file: {files_to_remove}\n")
+            stat = os.stat(video_path)
         except OSError as e:
-            print(f"  - Error removing file {files_to_remove}: {e}")
\ No newline at end of file
+            print(f"  - Error tracking temp file {filename}: {e}")
+            return
+        self.add_clip(filename, stat.st_size, stat.st_mtime)
+        TEMP_DISK_BYTES.set(self.total_bytes)
+
+    def mark_aired(self, video_path, aired_at):
+        with self.lock:
+            clip = self.clips.get(os.path.basename(video_path))
+            if clip is not None:
+                clip['aired_at'] = aired_at
+
+    def over_budget(self):
+        return bool(self.max_bytes) and self.total_bytes > self.max_bytes
+
+    def evict(self, referenced_files, now=None):
+        now = now if now is not None else time.time()
+        with self.lock:
+            candidates = {filename: clip for filename, clip in self.clips.items() if filename not in referenced_files}
+            files_to_remove = [filename for filename, clip in candidates.items() if now - clip['created_at'] > self.min_age_minutes * 60]
+            remaining_bytes = self.total_bytes - sum(candidates[filename]['size'] for filename in files_to_remove)
+
+            if self.max_bytes and remaining_bytes > self.max_bytes:
+                # Over budget: drop the clips that finished airing longest ago first.
+                aired = sorted(
+                    (clip['aired_at'], filename) for filename, clip in candidates.items()
+                    if clip['aired_at'] is not None and clip['aired_at'] <= now and filename not in files_to_remove
+                )
+                for _, filename in aired:
+                    if remaining_bytes <= self.max_bytes:
+                        break
+                    files_to_remove.append(filename)
+                    remaining_bytes -= candidates[filename]['size']
+
+            for filename in files_to_remove:
+                try:
+                    os.remove(os.path.join(self.temp_directory, filename))
+                    print(f" - Removed old temporary file: {filename}")
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    print(f"  - Error removing file {filename}: {e}")
+                    continue
+                self.total_bytes -= self.clips.pop(filename)['size']
+
+        TEMP_DISK_BYTES.set(self.total_bytes)
+        if self.over_budget():
+            print(f"  - Warning: temp directory uses {self.total_bytes} bytes, over the {self.max_bytes} byte budget, but the remaining clips are still needed")
+        return files_to_remove
@@ -0,0 +1,32 @@
+import time
+from datetime import datetime
+
+class SystemClock:
+    def time(self):
+        return time.time()
+
+    def now(self):
+        return datetime.now()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+class SimulatedClock:
+    # Time only moves when the caller advances it, so a replay can jump straight from one
+    # event to the next instead of sleeping in between.
+    def __init__(self, start):
+        self.current = start.timestamp() if isinstance(start, datetime) else float(start)
+
+    def time(self):
+        return self.current
+
+    def now(self):
+        return datetime.fromtimestamp(self.current)
+
+    def sleep(self, seconds):
+        self.current += max(0, seconds)
+
+    def advance_to(self, timestamp):
+        self.current = max(self.current, timestamp.timestamp() if isinstance(timestamp, datetime) else timestamp)
+
+SYSTEM_CLOCK = SystemClock()
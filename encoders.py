@@ -0,0 +1,164 @@
+import json
+import os
+import socket
+import subprocess
+import time
+
+BENCHMARK_FRAMES = 120
+BENCHMARK_SOURCE = 'testsrc2=size=1920x1080:rate=24'
+OUTPUT_FPS = 24
+DEFAULT_VAAPI_DEVICE = '/dev/dri/renderD128'
+DEFAULT_X264_PRESETS = ['ultrafast', 'veryfast', 'fast']
+
+class EncoderBackend:
+    def __init__(self, name, codec, input_args=None, video_filter='scale=w={width}:h={height},format=yuv420p', codec_args=None):
+        self.name = name
+        self.codec = codec
+        self.input_args = input_args or []
+        self.video_filter = video_filter
+        self.codec_args = codec_args or []
+
+    def output_args(self, width, height):
+        return ['-vf', self.video_filter.format(width=width, height=height), '-c:v', self.codec, *self.codec_args]
+
+    def __repr__(self):
+        return f"EncoderBackend({self.name})"
+
+def vaapi_backend(device=DEFAULT_VAAPI_DEVICE):
+    return EncoderBackend(
+        'vaapi',
+        'h264_vaapi',
+        input_args=['-vaapi_device', device],
+        video_filter='format=nv12,hwupload,scale_vaapi=w={width}:h={height}',
+        codec_args=['-profile:v', 'high', '-level', '40']
+    )
+
+def qsv_backend():
+    return EncoderBackend(
+        'qsv',
+        'h264_qsv',
+        video_filter='scale=w={width}:h={height},format=nv12',
+        codec_args=['-profile:v', 'high', '-level', '40']
+    )
+
+def nvenc_backend():
+    return EncoderBackend('nvenc', 'h264_nvenc', codec_args=['-profile:v', 'high', '-level', '4.0'])
+
+def x264_backend(preset):
+    return EncoderBackend(f'libx264-{preset}', 'libx264', codec_args=['-preset', preset, '-profile:v', 'high', '-level', '4.0'])
+
+def candidate_backends(vaapi_device=DEFAULT_VAAPI_DEVICE, x264_presets=None):
+    backends = []
+    if vaapi_device and os.path.exists(vaapi_device):
+        backends.append(vaapi_backend(vaapi_device))
+    backends.append(qsv_backend())
+    backends.append(nvenc_backend())
+    for preset in x264_presets or DEFAULT_X264_PRESETS:
+        backends.append(x264_backend(preset))
+    return backends
+
+def available_encoders():
+    try:
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    except OSError as e:
+        print(f" - Error listing ffmpeg encoders: {e}")
+        return set()
+    encoders = set()
+    for line in result.stdout.splitlines():
+        fields = line.split()
+        if len(fields) >= 2 and fields[0].startswith('V'):
+            encoders.add(fields[1])
+    return encoders
+
+def ffmpeg_version():
+    try:
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-version'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    except OSError:
+        return 'unknown'
+    return result.stdout.splitlines()[0] if result.stdout else 'unknown'
+
+def benchmark_backend(backend, width=1280, height=720):
+    # Encodes a few seconds of a synthetic 1080p source and returns the achieved frames
+    # per second, or None if this backend does not work on this machine.
+    cmd = [
+        'ffmpeg',
+        '-hide_banner',
+        '-nostdin',
+        *backend.input_args,
+        '-f', 'lavfi',
+        '-i', BENCHMARK_SOURCE,
+        '-frames:v', str(BENCHMARK_FRAMES),
+        *backend.output_args(width, height),
+        '-r', str(OUTPUT_FPS),
+        '-g', '48',
+        '-bf', '0',
+        '-b:v', '2M',
+        '-f', 'null',
+        '-'
+    ]
+    start_time = time.monotonic()
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    elapsed_time = time.monotonic() - start_time
+    if result.returncode != 0:
+        return None
+    return BENCHMARK_FRAMES / max(elapsed_time, 1e-6)
+
+def load_encoder_cache(cache_path):
+    if not cache_path or not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f" - Error loading encoder cache {cache_path}: {e}")
+        return {}
+
+def save_encoder_cache(cache_path, cache):
+    if not cache_path:
+        return
+    temp_path = f"{cache_path}.tmp"
+    try:
+        with open(temp_path, 'w') as f:
+            json.dump(cache, f, indent=2)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        print(f" - Error saving encoder cache {cache_path}: {e}")
+
+def select_encoder(encoder_name='auto', vaapi_device=DEFAULT_VAAPI_DEVICE, x264_presets=None, cache_path=None):
+    backends = {backend.name: backend for backend in candidate_backends(vaapi_device, x264_presets)}
+    if encoder_name != 'auto':
+        if encoder_name == 'vaapi':
+            return vaapi_backend(vaapi_device)
+        if encoder_name not in backends:
+            raise RuntimeError(f"ERROR - Unknown encoder backend: {encoder_name}")
+        return backends[encoder_name]
+
+    cache_key = f"{socket.gethostname()}|{ffmpeg_version()}|{vaapi_device}|{','.join(backends)}"
+    cache = load_encoder_cache(cache_path)
+    cached = cache.get(cache_key)
+    if cached and cached.get('encoder') in backends:
+        print(f" - Using cached encoder backend: {cached['encoder']}")
+        return backends[cached['encoder']]
+
+    print(" - Probing encoder backends...")
+    supported = available_encoders()
+    results = {}
+    for name, backend in backends.items():
+        if backend.codec not in supported:
+            continue
+        fps = benchmark_backend(backend)
+        if fps is not None:
+            results[name] = fps
+            print(f"   - {name}: {fps:.1f} fps")
+
+    if not results:
+        raise RuntimeError("ERROR - No working ffmpeg H.264 encoder found")
+
+    chosen = max(results, key=lambda name: results[name])
+    print(f" - Selected encoder backend: {chosen}")
+    if results[chosen] < OUTPUT_FPS:
+        print(f" - Warning: no encoder backend keeps up with real time ({OUTPUT_FPS} fps)")
+
+    cache[cache_key] = {'encoder': chosen, 'fps': results}
+    save_encoder_cache(cache_path, cache)
+    return backends[chosen]
@@ -1,111 +1,242 @@
-import heapq
+import functools
 import os
 import re
-import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from watchdog.events import FileSystemEventHandler
 from watchdog.observers import Observer
+from probe_cache import ProbeCache
+from scheduler import Scheduler
+from metrics import FILE_DETECTION_SECONDS
+from clock import SYSTEM_CLOCK
+from video_processing import keep_segments
+
+DEFAULT_SETTLE_SECONDS = 2
+
+FILENAME_PATTERN = re.compile(r'(\d{2})(\d{2})(\d{2})-Camera(\d+)-(Snapshot|Recording)\.(jpg|mp4)')
+
+@functools.lru_cache(maxsize=64)
+def parse_day_directory(day_directory):
+    # Every file in a Blink day folder shares the date, so it is parsed once per folder.
+    year_str, month_str, day_str = day_directory.split(os.sep)[-3:]
+    return datetime.strptime(f"{year_str}/{month_str}/{day_str}", '%Y/%m-%B/%d')
 
 class FileWatcher:
-    def __init__(self, watch_directory, duration, delay_minutes, temp_directory):
+    def __init__(self, watch_directory, duration, delay_minutes, temp_directory, probe_cache=None, journal=None, camera=None, settle_seconds=DEFAULT_SETTLE_SECONDS, clock=SYSTEM_CLOCK, trim_static_seconds=0, static_hold_seconds=2):
         self.watch_directory = watch_directory
+        self.trim_static_seconds = trim_static_seconds
+        self.static_hold_seconds = static_hold_seconds
+        self.clock = clock
+        self.camera = camera
+        self.settle_seconds = settle_seconds
         self.duration = duration  
-        self.time_left = duration
         self.delay_minutes = delay_minutes
-        self.queue = []
+        self.scheduler = Scheduler(duration)
         self.observer = Observer()
         self.event_handler = FileSystemEventHandler()
         self.event_handler.on_created = self.on_created
+        self.event_handler.on_modified = self.on_modified
+        self.event_handler.on_moved = self.on_moved
+        self.event_handler.on_closed = self.on_closed
         self.temp_directory = temp_directory
-        self.processed_files = set()
+        self.processed_files = {}
+        self.probe_cache = probe_cache if probe_cache is not None else ProbeCache()
+        self.journal = journal
+        # Files seen by the observer but not yet complete, keyed by path, with the size and
+        # mtime last seen and when they last changed. Watchdog reports several events per
+        # file while it is written; they all collapse into one entry here.
+        self.pending_files = {}
+        self.ingested_files = {}
+        self.pending_lock = threading.Lock()
+        self.pending_condition = threading.Condition(self.pending_lock)
+        self.settle_thread = None
+        self.running = False
+        # Static-scene analysis decodes the whole recording, so it runs on its own thread
+        # rather than on the observer, settle or startup threads, keyed by path until the
+        # encode picks up the result.
+        self.analysis_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='static-analysis') if trim_static_seconds else None
+        self.static_analyses = {}
 
     def on_created(self, event):
-        if not event.is_directory and os.path.isfile(event.src_path):
-            print(f"  --------------------------------------------------------------")
-            print(f"  --- Detected new file: {os.path.basename(event.src_path)} ---")
-            if event.src_path.endswith(('.mp4', '.jpg')):
-                timestamp = self.extract_timestamp(event.src_path)
-                if timestamp:
-                    file_type = 'recording' if event.src_path.endswith('.mp4') else 'snapshot'
-                    heapq.heappush(self.queue, (timestamp, event.src_path, file_type))
-                    self.reorder_and_adjust_queue(self.temp_directory) 
-            else:
-                print(f"  - File detected is neither a snapshot nor a recording, skipping: {os.path.basename(event.src_path)}")
-
-    def mark_processed(self, file_path):
-        self.processed_files.add(file_path)
-
-    def reorder_and_adjust_queue(self, temp_directory):
-        new_queue = []
-
-        for item in sorted(self.queue):
-            timestamp, file_path, file_type = item[:3]  
-            adjusted_duration = item[3] if len(item) > 3 else None 
-
-            if file_type == 'recording':
-                print(f"  -RRR- Processing a Recording: {os.path.basename(file_path)} -RRR- ")
-                recording_duration = self.get_video_duration(file_path)
-                self.time_left -= recording_duration
-                new_queue.append((timestamp, file_path, file_type))
-                print(f"  - Recording ({os.path.basename(file_path)}) has a duration of {recording_duration}s. Duration for next snapshot is {self.time_left}s")
-            elif file_type == 'snapshot':
-                print(f"  -SSS- Processing a Snapshot: {os.path.basename(file_path)}, {self.time_left}s -SSS- ")
-                video_filename = os.path.basename(file_path).replace('.jpg', '.mp4')
-                video_path = os.path.join(temp_directory, video_filename)
-                if os.path.exists(video_path):
-                    continue
+        if not event.is_directory:
+            self.track_pending(event.src_path)
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self.track_pending(event.src_path)
+
+    def on_moved(self, event):
+        # Files written under a temporary name and renamed into place are complete on arrival.
+        if not event.is_directory:
+            self.ingest_file(event.dest_path)
+
+    def on_closed(self, event):
+        # Close-after-write events (inotify) mean the writer is done, so there is no need to
+        # wait for the size to settle.
+        if not event.is_directory:
+            with self.pending_lock:
+                tracked = self.pending_files.pop(event.src_path, None) is not None
+            if tracked:
+                self.ingest_file(event.src_path)
+
+    def track_pending(self, file_path):
+        if self.camera is not None and self.extract_camera(file_path) != self.camera:
+            # Another camera's pipeline handles this file.
+            return
+        with self.pending_condition:
+            if file_path in self.ingested_files or file_path in self.processed_files:
+                return
+            if file_path not in self.pending_files:
+                self.pending_files[file_path] = (None, None, time.monotonic())
+                self.pending_condition.notify_all()
 
-                if self.time_left <= 0:
-                    self.time_left = self.duration
+    def settle_pending_files(self):
+        # Polls the files that are still being written and ingests each one once its size
+        # and mtime have not changed for settle_seconds.
+        with self.pending_condition:
+            while self.running:
+                now = time.monotonic()
+                settled = []
+                for file_path, (size, mtime, changed_at) in list(self.pending_files.items()):
+                    try:
+                        stat = os.stat(file_path)
+                    except OSError:
+                        del self.pending_files[file_path]
+                        continue
+                    if (stat.st_size, stat.st_mtime_ns) != (size, mtime):
+                        self.pending_files[file_path] = (stat.st_size, stat.st_mtime_ns, now)
+                    elif stat.st_size > 0 and now - changed_at >= self.settle_seconds:
+                        del self.pending_files[file_path]
+                        settled.append(file_path)
+
+                if settled:
+                    self.pending_condition.release()
+                    try:
+                        for file_path in settled:
+                            self.ingest_file(file_path)
+                    finally:
+                        self.pending_condition.acquire()
                     continue
-                
-                if adjusted_duration is None:
-                    print ("")
-                else:
-                    print(f"  - Adjusted snapshot ({os.path.basename(file_path)}) duration from {adjusted_duration}s to {min(adjusted_duration, self.time_left)}s due to reduced time left")
-                
-                adjusted_duration = min(self.time_left, self.duration) if adjusted_duration is None else min(adjusted_duration, self.time_left)
-                new_queue.append((timestamp, file_path, file_type, adjusted_duration))
-                print(f"  --------------------------------------------------------------\n")
-                self.time_left = self.duration
-
-        self.queue = new_queue
+
+                timeout = None if not self.pending_files else min(0.5, self.settle_seconds)
+                self.pending_condition.wait(timeout)
+
+    def ingest_file(self, file_path):
+        if not os.path.isfile(file_path):
+            return
+        if self.camera is not None and self.extract_camera(file_path) != self.camera:
+            return
+        with self.pending_lock:
+            if file_path in self.ingested_files:
+                return
+            self.ingested_files[file_path] = self.clock.now()
+        try:
+            FILE_DETECTION_SECONDS.observe(max(0, time.time() - os.path.getmtime(file_path)))
+        except OSError:
+            pass
+        print(f"  --------------------------------------------------------------")
+        print(f"  --- Detected new file: {os.path.basename(file_path)} ---")
+        if file_path.endswith(('.mp4', '.jpg')):
+            timestamp = self.extract_timestamp(file_path)
+            if timestamp:
+                file_type = 'recording' if file_path.endswith('.mp4') else 'snapshot'
+                self.add_to_queue(timestamp, file_path, file_type)
+        else:
+            print(f"  - File detected is neither a snapshot nor a recording, skipping: {os.path.basename(file_path)}")
+
+    def mark_processed(self, file_path, timestamp=None, video_file=None, duration=None, loop_duration=None):
+        self.processed_files[file_path] = timestamp or self.clock.now()
+        if self.journal is not None and video_file is not None:
+            self.journal.record_encoded(file_path, video_file, duration, loop_duration)
+
+    def prune_processed(self, before):
+        # processed_files only needs to cover the delay window; anything older can't be queued again.
+        for file_path, timestamp in list(self.processed_files.items()):
+            if timestamp < before:
+                del self.processed_files[file_path]
+        with self.pending_lock:
+            for file_path, ingested_at in list(self.ingested_files.items()):
+                if ingested_at < before:
+                    del self.ingested_files[file_path]
+
+    def add_to_queue(self, timestamp, file_path, file_type, recording_duration=None):
+        if file_path in self.processed_files:
+            return False
+        if file_type == 'recording':
+            print(f"  -RRR- Processing a Recording: {os.path.basename(file_path)} -RRR- ")
+            if recording_duration is None:
+                recording_duration = self.get_video_duration(file_path)
+        else:
+            print(f"  -SSS- Processing a Snapshot: {os.path.basename(file_path)} -SSS- ")
+            # With a journal, processed_files already holds every snapshot that finished encoding.
+            video_filename = os.path.basename(file_path).replace('.jpg', '.mp4')
+            if self.journal is None and os.path.exists(os.path.join(self.temp_directory, video_filename)):
+                return False
+        added = self.scheduler.add(timestamp, file_path, file_type, recording_duration)
+        if added and self.journal is not None:
+            self.journal.record_ingested([(timestamp, file_path, file_type)])
+        if added and file_type == 'recording':
+            self.analyze_recording(file_path, recording_duration)
+        print(f"  --------------------------------------------------------------\n")
+        return added
 
     def get_video_duration(self, recording_path):
+        return self.probe_cache.get_duration(recording_path)
+
+    def recording_segments(self, recording_path, duration=None):
+        # With static-scene trimming on, the spans of the recording worth airing, or None to
+        # air all of it. The analysis is cached with the other probe results; an encode that
+        # starts while the background analysis is still running waits for it and uses its
+        # result, even a failed one, instead of decoding the file again.
+        if not self.trim_static_seconds:
+            return None
+        with self.pending_lock:
+            analysis = self.static_analyses.pop(recording_path, None)
+        if analysis is not None:
+            try:
+                return analysis.result()
+            except Exception as e:
+                print(f"  - Error analyzing {os.path.basename(recording_path)} for static scenes: {e}")
+                return None
+        duration = duration if duration is not None else self.get_video_duration(recording_path)
+        static_spans = self.probe_cache.get_static_spans(recording_path, self.trim_static_seconds)
+        if not duration or not static_spans:
+            return None
+        return keep_segments(duration, static_spans, self.static_hold_seconds)
+
+    def analyze_recording(self, recording_path, duration):
+        # Queued recordings start out budgeted at their full length; once the analysis finds
+        # what trimming removes, the snapshot after the recording gets that time back.
+        if self.analysis_executor is None:
+            return
+        self.scheduler.expect_update(recording_path)
+        with self.pending_lock:
+            self.static_analyses[recording_path] = self.analysis_executor.submit(self.update_airtime, recording_path, duration)
+
+    def update_airtime(self, recording_path, duration):
+        # Always reports back to the scheduler, even when nothing is trimmed, so it stops
+        # tracking the recording. Returns the segments to keep, as recording_segments does.
+        airtime = duration
+        segments = None
         try:
-            result = subprocess.run(
-                [
-                    'ffprobe',
-                    '-v', 'error',
-                    '-show_entries', 'format=duration',
-                    '-of', 'default=noprint_wrappers=1:nokey=1',
-                    recording_path
-                ],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-            duration = float(result.stdout)
-            return duration
-        except ValueError as e:
-            print(f" - Error parsing duration: {e}")
-        except subprocess.CalledProcessError as e:
-            print(f" - ffprobe error: {e.stderr}")
-        return 0 
+            static_spans = self.probe_cache.get_static_spans(recording_path, self.trim_static_seconds)
+            segments = keep_segments(duration, static_spans, self.static_hold_seconds) if duration and static_spans else None
+            if segments is not None:
+                airtime = sum(end - start for start, end in segments)
+                print(f"  - Trimmed static scenes from {os.path.basename(recording_path)}: {duration}s -> {airtime:.1f}s")
+        finally:
+            self.scheduler.update_duration(recording_path, airtime)
+        return segments
 
     def extract_timestamp(self, file_path):
-        match = re.search(r'(\d{6})-Camera\d+-(Snapshot|Recording)\.(jpg|mp4)', os.path.basename(file_path))
+        match = FILENAME_PATTERN.search(os.path.basename(file_path))
         if match:
-            time_str = match.group(1)
-            path_components = file_path.split(os.sep)
-            day_str = path_components[-2]
-            month_str = path_components[-3]
-            year_str = path_components[-4]
-            
-            timestamp_str = f"{year_str}/{month_str}/{day_str}/{time_str}"
-            
+            hour, minute, second = match.group(1, 2, 3)
             try:
-                timestamp = datetime.strptime(timestamp_str, '%Y/%m-%B/%d/%H%M%S')
+                day = parse_day_directory(os.path.dirname(file_path))
+                timestamp = day.replace(hour=int(hour), minute=int(minute), second=int(second))
                 return timestamp
             except ValueError as e:
                 print(f" - Error parsing timestamp: {e}")
@@ -113,17 +244,25 @@ class FileWatcher:
             print(f" - No timestamp found in file name: {os.path.basename(file_path)}")
         return None
     
+    def extract_camera(self, file_path):
+        match = FILENAME_PATTERN.search(os.path.basename(file_path))
+        return int(match.group(4)) if match else None
+
     def print_queue(self):
         print("  Current Queue:")
-        for item in self.queue:
-            scheduled_time, file_path, file_type = item[:3]
-            optional_duration = item[3] if len(item) > 3 else "Default"
+        for scheduled_time, file_path, file_type, optional_duration in self.scheduler.queued_items():
             print(f"    Scheduled Time: {scheduled_time.strftime('%Y-%m-%d %H:%M:%S')}, "
                   f"File Path: {os.path.basename(file_path)}, "
                   f"File Type: {file_type}, "
                   f"Duration: {optional_duration}\n")
 
     def start(self):
+        if self.journal is not None:
+            window_start = self.clock.now() - timedelta(minutes=self.delay_minutes)
+            self.processed_files.update(self.journal.processed_paths(window_start))
+        self.running = True
+        self.settle_thread = threading.Thread(target=self.settle_pending_files, daemon=True)
+        self.settle_thread.start()
         self.observer.schedule(self.event_handler, self.watch_directory, recursive=True)
         self.observer.start()
         self.scan_existing_files()
@@ -131,28 +270,72 @@ class FileWatcher:
     def stop(self):
         self.observer.stop()
         self.observer.join()
+        with self.pending_condition:
+            self.running = False
+            self.pending_condition.notify_all()
+        if self.settle_thread is not None:
+            self.settle_thread.join()
+        if self.analysis_executor is not None:
+            self.analysis_executor.shutdown(wait=False, cancel_futures=True)
         
     def scan_existing_files(self):
-        now = datetime.now()
+        # Covers every day folder that overlaps the delay window, so a restart shortly after
+        # midnight still picks up the end of the previous day.
+        now = self.clock.now()
         delay_time = now - timedelta(minutes=self.delay_minutes)  
-        today_path = os.path.join(
-            self.watch_directory,
-            'Snapshots',
-            now.strftime('%Y/%m-%B/%d')
-        )
-
-        if not os.path.exists(today_path):
-            return
+        encoded_files = set()
+        if self.journal is None:
+            try:
+                encoded_files = {entry.name for entry in os.scandir(self.temp_directory)}
+            except OSError:
+                pass
 
-        all_files = [f for f in os.listdir(today_path) if f.endswith(('.jpg', '.mp4'))]
-        sorted_files = sorted(all_files)
+        pending = []
+        day = delay_time.date()
+        while day <= now.date():
+            day_path = os.path.join(self.watch_directory, 'Snapshots', day.strftime('%Y/%m-%B/%d'))
+            day_start = datetime(day.year, day.month, day.day)
+            day += timedelta(days=1)
+            try:
+                entries = os.scandir(day_path)
+            except OSError:
+                continue
+            with entries:
+                for entry in entries:
+                    match = FILENAME_PATTERN.search(entry.name)
+                    if not match or not entry.is_file():
+                        continue
+                    if self.camera is not None and int(match.group(4)) != self.camera:
+                        continue
+                    hour, minute, second = match.group(1, 2, 3)
+                    try:
+                        timestamp = day_start.replace(hour=int(hour), minute=int(minute), second=int(second))
+                    except ValueError:
+                        continue
+                    if not delay_time <= timestamp <= now or entry.path in self.processed_files:
+                        continue
+                    if time.time() - entry.stat().st_mtime < self.settle_seconds:
+                        # Still being written; the settle thread picks it up once it is complete.
+                        self.track_pending(entry.path)
+                        continue
+                    file_type = 'recording' if match.group(6) == 'mp4' else 'snapshot'
+                    if file_type == 'snapshot' and entry.name.replace('.jpg', '.mp4') in encoded_files:
+                        continue
+                    pending.append((timestamp, entry.path, file_type))
 
         print("")
 
-        for filename in sorted_files:
-            file_path = os.path.join(today_path, filename)
-            timestamp = self.extract_timestamp(file_path)
-            if timestamp and delay_time <= timestamp <= now: 
-                file_type = 'recording' if filename.endswith('.mp4') else 'snapshot'
-                heapq.heappush(self.queue, (timestamp, file_path, file_type))
-                print(f" - Added to queue: {os.path.basename(file_path)}")
\ No newline at end of file
+        with self.pending_lock:
+            self.ingested_files.update((file_path, now) for _, file_path, _ in pending)
+
+        recording_paths = [file_path for _, file_path, file_type in pending if file_type == 'recording']
+        recording_durations = self.probe_cache.get_durations(recording_paths) if recording_paths else {}
+        added = self.scheduler.add_many(
+            (timestamp, file_path, file_type, recording_durations.get(file_path))
+            for timestamp, file_path, file_type in pending
+        )
+        if self.journal is not None:
+            self.journal.record_ingested(pending)
+        for file_path in recording_paths:
+            self.analyze_recording(file_path, recording_durations.get(file_path))
+        print(f" - Added {added} existing file(s) from the last {self.delay_minutes} minutes to the queue")
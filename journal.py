@@ -0,0 +1,95 @@
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+class Journal:
+    # Persistent record of every ingested file: when it was queued, the clip it was encoded
+    # to and when that clip is due to air. Rows older than the delay window are compacted away.
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(journal_path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS items (
+                source_path TEXT PRIMARY KEY,
+                timestamp REAL NOT NULL,
+                file_type TEXT NOT NULL,
+                state TEXT NOT NULL,
+                output_path TEXT,
+                duration REAL,
+                loop_duration REAL,
+                aired_at REAL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS items_timestamp ON items (timestamp)")
+
+    def record_ingested(self, entries):
+        now = time.time()
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO items (source_path, timestamp, file_type, state, updated_at) VALUES (?, ?, ?, 'ingested', ?)",
+                [(file_path, timestamp.timestamp(), file_type, now) for timestamp, file_path, file_type in entries]
+            )
+
+    def record_encoded(self, source_path, output_path, duration, loop_duration):
+        with self.lock:
+            self.connection.execute(
+                "UPDATE items SET state = 'encoded', output_path = ?, duration = ?, loop_duration = ?, updated_at = ? WHERE source_path = ?",
+                (output_path, duration, loop_duration, time.time(), source_path)
+            )
+
+    def record_aired(self, source_path, aired_at):
+        with self.lock:
+            self.connection.execute(
+                "UPDATE items SET state = 'aired', aired_at = ?, updated_at = ? WHERE source_path = ?",
+                (aired_at, time.time(), source_path)
+            )
+
+    def record_clip_aired(self, output_path, aired_at):
+        # The playlist reached the clip: replaces the estimate recorded when it was queued.
+        # Returns the clip's source file, or None for clips the journal does not know.
+        with self.lock:
+            row = self.connection.execute("SELECT source_path FROM items WHERE output_path = ?", (output_path,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute(
+                "UPDATE items SET state = 'aired', aired_at = ?, updated_at = ? WHERE output_path = ?",
+                (aired_at, time.time(), output_path)
+            )
+        return row[0]
+
+    def processed_paths(self, since):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT source_path, timestamp FROM items WHERE state IN ('encoded', 'aired') AND timestamp >= ?",
+                (since.timestamp(),)
+            ).fetchall()
+        return {source_path: datetime.fromtimestamp(timestamp) for source_path, timestamp in rows}
+
+    def resumable_clips(self, since, now):
+        # Clips that were encoded but had not aired yet when the service stopped, in schedule order.
+        with self.lock:
+            rows = self.connection.execute(
+                """
+                SELECT source_path, output_path, duration, loop_duration FROM items
+                WHERE timestamp >= ? AND (state = 'encoded' OR (state = 'aired' AND aired_at > ?))
+                ORDER BY timestamp, source_path
+                """,
+                (since.timestamp(), now.timestamp())
+            ).fetchall()
+        return rows
+
+    def compact(self, before):
+        with self.lock:
+            deleted = self.connection.execute("DELETE FROM items WHERE timestamp < ?", (before.timestamp(),)).rowcount
+        return deleted
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
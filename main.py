@@ -1,23 +1,139 @@
-import heapq
+import functools
 import time
 import threading
 import os
 import subprocess
 import json
 
-from datetime import datetime
+from datetime import timedelta
 from file_watcher import FileWatcher
 from playlist_manager import PlaylistManager
-from video_processing import create_video_from_snapshot, reencode_video
-from streaming_server import start_streaming_server
-from cleanup import cleanup_temp_files
+from video_processing import create_video_from_snapshot, create_videos_from_snapshots, reencode_video, SNAPSHOT_LOOP_SECONDS
+from streaming_server import StreamSupervisor
+from segment_feeder import SegmentFeeder
+from cleanup import TempFileEvictor
+from transcode_pool import TranscodePool
+from probe_cache import ProbeCache
+from encoders import select_encoder
+from journal import Journal
+from supervisor import supervise
+from clock import SYSTEM_CLOCK
+from metrics import registry, QUEUE_WAIT_SECONDS, ENCODE_SECONDS, ENCODE_REALTIME_FACTOR, ENCODE_FAILURES, AIR_DELAY_SECONDS, QUEUE_LENGTH
+
+CLEANUP_INTERVAL_SECONDS = 60
 
 def load_settings():
     with open('settings.json', 'r') as f:
         return json.load(f)
 
-def main():
-    settings = load_settings()
+def measured_durations(file_watcher, clips):
+    # The playlist schedules switches from clip lengths, so they are taken from the encoded
+    # files rather than the requested durations: a recording airs for its output's length and
+    # a snapshot loop repeats at the real length of its clip. Requested values are kept when
+    # a probe fails.
+    probed = file_watcher.probe_cache.get_durations(list(clips))
+    measured = {}
+    for video_file, (adjusted_duration, loop_duration) in clips.items():
+        duration = probed.get(video_file)
+        if not duration:
+            measured[video_file] = (adjusted_duration, loop_duration)
+        elif loop_duration:
+            measured[video_file] = (adjusted_duration, duration)
+        else:
+            measured[video_file] = (duration, loop_duration)
+    return measured
+
+def process_queue_item(file_watcher, item, temp_directory, duration, encoder, queued_at=None):
+    timestamp, file_path, file_type, optional_duration = item
+    start_time = time.monotonic()
+    if queued_at is not None:
+        QUEUE_WAIT_SECONDS.observe(start_time - queued_at)
+    if file_type == 'snapshot':
+        adjusted_duration = optional_duration if optional_duration is not None else duration
+        print(f"  **MAIN SCRIPT** Adjusted Duration ({adjusted_duration}) = Optional Duration ({optional_duration}) if {optional_duration} else {duration}\n")
+        video_file = create_video_from_snapshot(file_path, adjusted_duration, temp_directory, encoder)
+        loop_duration = SNAPSHOT_LOOP_SECONDS
+    else:
+        adjusted_duration = optional_duration if optional_duration is not None else file_watcher.get_video_duration(file_path)
+        stream_info = file_watcher.probe_cache.get_stream_info(file_path)
+        segments = file_watcher.recording_segments(file_path)
+        video_file = reencode_video(file_path, temp_directory, adjusted_duration, stream_info, encoder, segments)
+        loop_duration = None
+    encode_time = time.monotonic() - start_time
+    ENCODE_SECONDS.observe(encode_time, type=file_type)
+    ENCODE_REALTIME_FACTOR.observe((loop_duration or adjusted_duration) / max(encode_time, 1e-6), type=file_type)
+    adjusted_duration, loop_duration = measured_durations(file_watcher, {video_file: (adjusted_duration, loop_duration)})[video_file]
+    file_watcher.mark_processed(file_path, timestamp, video_file, adjusted_duration, loop_duration)
+    return file_path, video_file, adjusted_duration, loop_duration
+
+def process_snapshot_batch(file_watcher, items, temp_directory, duration, encoder, queued_at=None):
+    # A burst of snapshots shares one ffmpeg run. Each keeps its own adjusted duration, which
+    # only affects how long the playlist loops its clip. If the batch fails (a corrupt image
+    # fails the whole run), the snapshots are encoded one by one instead.
+    if len(items) == 1:
+        return [process_queue_item(file_watcher, items[0], temp_directory, duration, encoder, queued_at)]
+    start_time = time.monotonic()
+    if queued_at is not None:
+        QUEUE_WAIT_SECONDS.observe(start_time - queued_at)
+    snapshots = [(file_path, optional_duration if optional_duration is not None else duration) for _, file_path, _, optional_duration in items]
+    try:
+        video_files = create_videos_from_snapshots(snapshots, temp_directory, encoder)
+    except subprocess.CalledProcessError as e:
+        print(f"  - Error encoding a batch of {len(items)} snapshots, encoding them one by one: {e}")
+        results = []
+        for item in items:
+            try:
+                results.append(process_queue_item(file_watcher, item, temp_directory, duration, encoder))
+            except Exception as e:
+                ENCODE_FAILURES.inc()
+                print(f"  - Error processing snapshot {os.path.basename(item[1])}: {e}")
+        return results
+    encode_time = (time.monotonic() - start_time) / len(items)
+    measured = measured_durations(file_watcher, {video_file: (adjusted_duration, SNAPSHOT_LOOP_SECONDS) for (_, adjusted_duration), video_file in zip(snapshots, video_files)})
+    results = []
+    for (timestamp, file_path, _, _), video_file in zip(items, video_files):
+        ENCODE_SECONDS.observe(encode_time, type='snapshot')
+        ENCODE_REALTIME_FACTOR.observe(SNAPSHOT_LOOP_SECONDS / max(encode_time, 1e-6), type='snapshot')
+        adjusted_duration, loop_duration = measured[video_file]
+        file_watcher.mark_processed(file_path, timestamp, video_file, adjusted_duration, loop_duration)
+        results.append((file_path, video_file, adjusted_duration, loop_duration))
+    return results
+
+def deliver_video(playlist_manager, file_path, video_file, adjusted_duration, loop_duration, journal=None, evictor=None, clock=SYSTEM_CLOCK):
+    air_in = playlist_manager.add_video_to_playlist(video_file, adjusted_duration, loop_duration)
+    if evictor is not None:
+        evictor.track(video_file)
+    if air_in is not None:
+        if journal is not None:
+            journal.record_aired(file_path, clock.time() + air_in)
+        if evictor is not None:
+            evictor.mark_aired(video_file, clock.time() + air_in)
+
+def clip_on_air(journal, video_file, aired_at):
+    # Called when a clip really starts airing, which is what the journal and the air delay
+    # metric record.
+    source_path = journal.record_clip_aired(video_file, aired_at)
+    if source_path is None:
+        return
+    try:
+        AIR_DELAY_SECONDS.observe(max(0, aired_at - os.path.getmtime(source_path)))
+    except OSError:
+        pass
+
+def deliver_finished_videos(transcode_pool, playlist_manager, journal=None, evictor=None, now=None, clock=SYSTEM_CLOCK):
+    for scheduled_time, future in transcode_pool.pop_finished(now):
+        try:
+            result = future.result()
+        except Exception as e:
+            ENCODE_FAILURES.inc()
+            print(f"  - Error processing item scheduled for {scheduled_time.strftime('%Y-%m-%d %H:%M:%S')}: {e}")
+            continue
+        # Snapshot batches finish as one job and return one result per snapshot.
+        for file_path, video_file, adjusted_duration, loop_duration in (result if isinstance(result, list) else [result]):
+            deliver_video(playlist_manager, file_path, video_file, adjusted_duration, loop_duration, journal, evictor, clock)
+        print("")
+
+def run_pipeline(settings, encoder=None, camera=None, encode_slots=None, clock=SYSTEM_CLOCK):
     watch_directory = settings['watch_directory']
     delay_minutes = settings['delay_minutes']
     stream_url = settings['stream_url']
@@ -26,118 +142,192 @@ def main():
     playlist_dir = settings['playlist_dir']
     placeholder_dir = settings['placeholder_dir']
     excluded_files = settings['excluded_files']
+    max_concurrent_encodes = settings.get('max_concurrent_encodes', 2)
+    probe_cache_path = settings.get('probe_cache_path', 'probe_cache.json')
+    probe_cache_max_entries = settings.get('probe_cache_max_entries', 2048)
+    vaapi_device = settings.get('ffmpeg_vaapi_device', '/dev/dri/renderD128')
+    encoder_name = settings.get('encoder', 'auto')
+    encoder_presets = settings.get('encoder_presets')
+    encoder_cache_path = settings.get('encoder_cache_path', 'encoder_cache.json')
+    streaming_mode = settings.get('streaming_mode', 'concat')
+    file_settle_seconds = settings.get('file_settle_seconds', 2)
+    trim_static_seconds = settings.get('trim_static_seconds', 0)
+    static_hold_seconds = settings.get('static_hold_seconds', 2)
+    snapshot_batch_window = settings.get('snapshot_batch_window_seconds', 1)
+    snapshot_batch_size = settings.get('snapshot_batch_size', 8)
+    air_delay = timedelta(minutes=settings.get('air_delay_minutes', 0))
+
+    journal_path = settings.get('journal_path', 'journal.db')
+    cleanup_min_age_minutes = settings.get('cleanup_min_age_minutes', 120)
+    temp_budget_mb = settings.get('temp_budget_mb', 0)
+    metrics_port = settings.get('metrics_port', 9101)
+    metrics_host = settings.get('metrics_host', '127.0.0.1')
+    metrics_snapshot_path = settings.get('metrics_snapshot_path', 'metrics.json')
+
+    if metrics_port:
+        # The endpoint is optional: a port already in use should not stop the stream.
+        try:
+            registry.start_http_server(metrics_port, metrics_host)
+            print(f" - Serving metrics on http://{metrics_host}:{metrics_port}/metrics")
+        except OSError as e:
+            print(f" - Error serving metrics on {metrics_host}:{metrics_port}, continuing without the endpoint: {e}")
+
+    if encoder is None:
+        encoder = select_encoder(encoder_name, vaapi_device, encoder_presets, encoder_cache_path)
 
-    file_watcher = FileWatcher(watch_directory, duration, delay_minutes, temp_directory)
+    probe_cache = ProbeCache(probe_cache_path, probe_cache_max_entries)
+    journal = Journal(journal_path)
+    evictor = TempFileEvictor(temp_directory, excluded_files, cleanup_min_age_minutes, temp_budget_mb * 1024 * 1024)
+    evictor.adopt_existing()
+
+    file_watcher = FileWatcher(watch_directory, duration, delay_minutes, temp_directory, probe_cache, journal, camera, file_settle_seconds, clock, trim_static_seconds, static_hold_seconds)
+    transcode_pool = TranscodePool(max_concurrent_encodes, on_finished=file_watcher.scheduler.wake, encode_slots=encode_slots)
     file_watcher.start()
 
-    print(f"\n 1. Initializing Playlist Manager...")
-    playlist_manager = PlaylistManager(playlist_dir, temp_directory, placeholder_dir, duration)
-    playlist_manager.initialize_playlists()
+    if streaming_mode == 'pipe':
+        # One persistent ffmpeg fed clip by clip; the placeholder airs until the first clip is ready.
+        print(f"\n 1. Starting the segment feeder...")
+        playlist_manager = SegmentFeeder(stream_url, temp_directory, placeholder_dir, duration, functools.partial(clip_on_air, journal))
+        playlist_manager_thread = None
+        stream_supervisor = None
+
+        window_start = clock.now() - timedelta(minutes=delay_minutes)
+        for source_path, output_path, clip_duration, loop_duration in journal.resumable_clips(window_start, clock.now()):
+            if os.path.exists(output_path):
+                deliver_video(playlist_manager, source_path, output_path, clip_duration, loop_duration, journal, evictor, clock)
 
-    active_playlist = os.path.basename(playlist_manager.active_playlist)
-    playlist_manager.current_index = 1
-    print(f" 2. Made the playlist `{active_playlist}` active")
-    print(" 3. Waiting for the first valid video file to be processed...")
+        playlist_manager.start()
+        print(f" 2. Streaming to {stream_url} through a single ffmpeg process")
+    else:
+        print(f"\n 1. Initializing Playlist Manager...")
+        playlist_manager = PlaylistManager(playlist_dir, temp_directory, placeholder_dir, duration, clock, functools.partial(clip_on_air, journal))
+        playlist_manager.initialize_playlists()
 
-    while not file_watcher.queue or file_watcher.queue[0][0] > datetime.now():
-        time.sleep(1)
+        active_playlist = os.path.basename(playlist_manager.active_playlist)
+        playlist_manager.current_index = 1
+        print(f" 2. Made the playlist `{active_playlist}` active")
 
-    if file_watcher.queue:
-        _, first_file, file_type, *optional_duration = file_watcher.queue[0]
-        if file_type == 'snapshot':
-            if first_file in file_watcher.processed_files:
-                print("")
-            else:
-                adjusted_duration = optional_duration[0] if optional_duration else duration
-                video_file = create_video_from_snapshot(first_file, adjusted_duration, temp_directory)
-                file_watcher.mark_processed(first_file)
-                time.sleep(1)
-        elif file_type == 'recording':
-            actual_duration = file_watcher.get_video_duration(first_file)
+        # Clips encoded before a restart that had not aired yet go straight back into the
+        # playlist, so the stream can resume without waiting for a fresh encode.
+        resumed = 0
+        window_start = clock.now() - timedelta(minutes=delay_minutes)
+        for source_path, output_path, clip_duration, loop_duration in journal.resumable_clips(window_start, clock.now()):
+            if os.path.exists(output_path):
+                deliver_video(playlist_manager, source_path, output_path, clip_duration, loop_duration, journal, evictor, clock)
+                resumed += 1
 
-            reencoded_file = reencode_video(first_file, temp_directory, actual_duration)
-            file_watcher.mark_processed(first_file)
+        if resumed:
+            print(f" 3. Resumed {resumed} clip(s) encoded before the last restart")
+        else:
+            print(" 3. Waiting for the first valid video file to be processed...")
 
-            video_file = reencoded_file  
-            adjusted_duration = actual_duration
+            first_item = file_watcher.scheduler.pop_due(clock.now())
+            while first_item is None:
+                file_watcher.scheduler.wait(clock.now())
+                first_item = file_watcher.scheduler.pop_due(clock.now())
 
-        time.sleep(1)
-        playlist_manager.add_video_to_playlist(video_file, adjusted_duration)
+            first_result = process_queue_item(file_watcher, first_item, temp_directory, duration, encoder)
+            release_in = (first_item[0] + air_delay - clock.now()).total_seconds()
+            if release_in > 0:
+                clock.sleep(release_in)
+            deliver_video(playlist_manager, *first_result, journal, evictor, clock)
 
-    playlist_manager_thread = threading.Thread(target=playlist_manager.run)
-    playlist_manager_thread.start()
+        # Playlist switches follow the position ffmpeg reports on its -progress pipe rather
+        # than the wall clock.
+        stream_supervisor = StreamSupervisor(playlist_manager, stream_url)
+        playlist_manager.follow_stream_position(stream_supervisor.stream_position)
 
-    playlist_manager.current_index = 0
-    print(f" 4. Made the playlist `{active_playlist}` active")
+        playlist_manager_thread = threading.Thread(target=playlist_manager.run)
+        playlist_manager_thread.start()
 
-    playlist_manager.finished_processing_first_video()
+        playlist_manager.current_index = 0
+        print(f" 4. Made the playlist `{active_playlist}` active")
 
-    ffmpeg_process = start_streaming_server(playlist_manager.active_playlist, stream_url)
-    print(f" 5. Started streaming rtsp feed with stream URL: {stream_url}")
+        playlist_manager.finished_processing_first_video()
+
+        stream_supervisor.start()
+        print(f" 5. Started streaming rtsp feed with stream URL: {stream_url}")
 
     print("\n --------- YOUR STREAM IS NOW UP AND RUNNING ---------\n")
 
+    next_cleanup_time = clock.time()
+    snapshot_batch = []
+    batch_deadline = None
+
     try:
         while True:
-            while file_watcher.queue and file_watcher.queue[0][0] <= datetime.now():
-                scheduled_time, next_file, file_type, *optional_duration = heapq.heappop(file_watcher.queue)
-                file_watcher.print_queue()
-                if file_type == 'snapshot':
-                    if next_file in file_watcher.processed_files:
-                        continue  
-                    adjusted_duration = optional_duration[0] if optional_duration else duration
-                    print(f"  **MAIN SCRIPT** Adjusted Duration ({adjusted_duration}) = Optional Duration ({optional_duration[0] if optional_duration else 'None'}) if {optional_duration} else {duration}\n")
-                    next_file = create_video_from_snapshot(next_file, adjusted_duration, temp_directory)
-                    file_watcher.mark_processed(next_file)
-                elif file_type == 'recording':
-                    actual_duration = file_watcher.get_video_duration(next_file)
-
-                    reencoded_file = reencode_video(next_file, temp_directory, actual_duration)
-                    file_watcher.mark_processed(next_file)
-
-                    next_file = reencoded_file  
-                    adjusted_duration = actual_duration
-
-                time.sleep(1)
-                playlist_manager.add_video_to_playlist(next_file, adjusted_duration)
-                print("")
-
-            cleanup_temp_files(temp_directory, excluded_files, min_age_minutes=120)
-
-            time.sleep(5)
-
-            if ffmpeg_process.poll() is not None:
-                print(f"FFmpeg process exited with code {ffmpeg_process.returncode}")
-                with open('ffmpeg_streaming_log.txt', 'r') as log_file:
-                    print(log_file.read())
-                ffmpeg_process = restart_streaming_server(ffmpeg_process, playlist_manager, stream_url)
+            while True:
+                item = file_watcher.scheduler.pop_due(clock.now())
+                if item is None:
+                    break
+                scheduled_time, next_file, file_type = item[:3]
+                if next_file in file_watcher.processed_files:
+                    continue
+                print(f"  - Due: {os.path.basename(next_file)} ({file_type}), {len(file_watcher.scheduler)} item(s) still queued")
+                if file_type == 'snapshot' and snapshot_batch_window > 0:
+                    # Snapshots due within the batch window are held back and encoded together.
+                    if not snapshot_batch:
+                        batch_deadline = clock.time() + snapshot_batch_window
+                    snapshot_batch.append(item)
+                    if len(snapshot_batch) < snapshot_batch_size:
+                        continue
+                if snapshot_batch:
+                    # Flushing before anything else is submitted keeps clips in scheduled order.
+                    transcode_pool.submit(snapshot_batch[0][0] + air_delay, process_snapshot_batch, file_watcher, snapshot_batch, temp_directory, duration, encoder, time.monotonic())
+                    snapshot_batch = []
+                if file_type != 'snapshot' or snapshot_batch_window <= 0:
+                    transcode_pool.submit(scheduled_time + air_delay, process_queue_item, file_watcher, item, temp_directory, duration, encoder, time.monotonic())
+
+            if snapshot_batch and clock.time() >= batch_deadline:
+                transcode_pool.submit(snapshot_batch[0][0] + air_delay, process_snapshot_batch, file_watcher, snapshot_batch, temp_directory, duration, encoder, time.monotonic())
+                snapshot_batch = []
+
+            # Items are encoded as soon as they are complete, earliest air time first, and each
+            # clip is held until its air time (the file timestamp plus air_delay_minutes).
+            deliver_finished_videos(transcode_pool, playlist_manager, journal, evictor, clock.now(), clock)
+            QUEUE_LENGTH.set(len(file_watcher.scheduler))
+
+            if evictor.over_budget():
+                evictor.evict(playlist_manager.referenced_files())
+
+            if clock.time() >= next_cleanup_time:
+                evictor.evict(playlist_manager.referenced_files())
+                window_start = clock.now() - timedelta(minutes=delay_minutes)
+                file_watcher.prune_processed(window_start)
+                journal.compact(window_start)
+                probe_cache.save()
+                if metrics_snapshot_path:
+                    registry.write_snapshot(metrics_snapshot_path)
+                next_cleanup_time = clock.time() + CLEANUP_INTERVAL_SECONDS
+
+            wake_time = min(next_cleanup_time, batch_deadline) if snapshot_batch else next_cleanup_time
+            next_release_time = transcode_pool.next_release_time()
+            if next_release_time is not None:
+                wake_time = min(wake_time, next_release_time.timestamp())
+            file_watcher.scheduler.wait(clock.now(), timeout=max(0, wake_time - clock.time()))
 
     except KeyboardInterrupt:
         file_watcher.stop()
+        transcode_pool.shutdown(wait=False)
+        if stream_supervisor is not None:
+            stream_supervisor.stop()
         playlist_manager.stop()
-        playlist_manager_thread.join()
+        if playlist_manager_thread is not None:
+            playlist_manager_thread.join()
+        registry.stop_http_server()
+        if metrics_snapshot_path:
+            registry.write_snapshot(metrics_snapshot_path)
+        journal.close()
+        probe_cache.save()
         print("\nFile watcher and playlist manager stopped due to KeyboardInterrupt")
+        print("  - Encoded clips were kept in the temp directory for the next start")
 
-        print("  - Removing temp video files and playlists")
-        for filename in os.listdir(temp_directory):
-            file_path = os.path.join(temp_directory, filename)
-            if (filename.endswith('.txt') or filename.endswith('.mp4')) and filename not in excluded_files:
-                try:
-                    os.remove(file_path)
-                except OSError as e:
-                    print(f"  - Error removing temp video file {filename}: {e}")
-
-def restart_streaming_server(ffmpeg_process, playlist_manager, stream_url):
-    if ffmpeg_process:
-        ffmpeg_process.terminate()
-        try:
-            ffmpeg_process.wait(timeout=10)
-        except subprocess.TimeoutExpired:
-            ffmpeg_process.kill()
-            ffmpeg_process.wait()
-    
-    print("\nERROR - FFmpeg process has stopped. Attempting to restart...\n")
-    return start_streaming_server(playlist_manager.active_playlist, stream_url)
+def main():
+    settings = load_settings()
+    if settings.get('cameras'):
+        supervise(settings, run_pipeline)
+    else:
+        run_pipeline(settings)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,163 @@
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+REALTIME_FACTOR_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128, 256, 1024)
+
+def format_labels(labels, extra=None):
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def label_key(self, labels):
+        return tuple(sorted(labels.items()))
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        with self.lock:
+            return [f"{self.name}{format_labels(key)} {value}" for key, value in self.values.items()]
+
+    def snapshot(self):
+        with self.lock:
+            return [{'labels': dict(key), 'value': value} for key, value in self.values.items()]
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.label_key(labels)] = value
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.label_key(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{format_labels(key, ('le', bound))} {bucket_count}")
+                lines.append(f"{self.name}_bucket{format_labels(key, ('le', '+Inf'))} {count}")
+                lines.append(f"{self.name}_sum{format_labels(key)} {total}")
+                lines.append(f"{self.name}_count{format_labels(key)} {count}")
+        return lines
+
+    def snapshot(self):
+        with self.lock:
+            return [
+                {'labels': dict(key), 'buckets': dict(zip(map(str, self.buckets), counts)), 'sum': total, 'count': count}
+                for key, (counts, total, count) in self.values.items()
+            ]
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+        self.server = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text):
+        return self.register(Counter(name, help_text))
+
+    def gauge(self, name, help_text):
+        return self.register(Gauge(name, help_text))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, buckets))
+
+    def render_prometheus(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        return {metric.name: {'type': metric.kind, 'help': metric.help_text, 'values': metric.snapshot()} for metric in self.metrics}
+
+    def write_snapshot(self, snapshot_path):
+        temp_path = f"{snapshot_path}.tmp"
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(self.snapshot(), f, indent=2)
+            os.replace(temp_path, snapshot_path)
+        except OSError as e:
+            print(f" - Error writing metrics snapshot {snapshot_path}: {e}")
+
+    def start_http_server(self, port, host='127.0.0.1'):
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render_prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server
+
+    def stop_http_server(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
+
+registry = MetricsRegistry()
+
+FILE_DETECTION_SECONDS = registry.histogram('blink_file_detection_seconds', 'Time from a file being written to the watcher detecting it')
+QUEUE_WAIT_SECONDS = registry.histogram('blink_queue_wait_seconds', 'Time a due item waits for a free encode worker')
+PROBE_SECONDS = registry.histogram('blink_probe_seconds', 'Wall time of ffprobe/ffmpeg probe processes')
+PROBE_PROCESSES = registry.counter('blink_probe_processes_total', 'Probe processes started')
+ENCODE_SECONDS = registry.histogram('blink_encode_seconds', 'Wall time of snapshot and recording encodes')
+ENCODE_REALTIME_FACTOR = registry.histogram('blink_encode_realtime_factor', 'Seconds of output produced per second of encode time', REALTIME_FACTOR_BUCKETS)
+ENCODE_FAILURES = registry.counter('blink_encode_failures_total', 'Encodes that raised an error')
+PLAYLIST_APPEND_SECONDS = registry.histogram('blink_playlist_append_seconds', 'Time spent adding a clip to the playlist')
+AIR_DELAY_SECONDS = registry.histogram('blink_air_delay_seconds', 'Time from a file being written to its clip starting to air')
+STREAM_RESTARTS = registry.counter('blink_stream_restarts_total', 'Restarts of the streaming ffmpeg process')
+STREAM_OUTAGE_SECONDS = registry.histogram('blink_stream_outage_seconds', 'Time from the streaming ffmpeg failing to its replacement producing output')
+TEMP_DISK_BYTES = registry.gauge('blink_temp_disk_bytes', 'Bytes used by clips in the temp directory')
+QUEUE_LENGTH = registry.gauge('blink_queue_length', 'Items waiting in the scheduler')
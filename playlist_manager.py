@@ -1,6 +1,8 @@
 import os
 import threading
 import time
+from metrics import PLAYLIST_APPEND_SECONDS
+from clock import SYSTEM_CLOCK
 
 def is_file_ready(file_path):
     try:
@@ -10,17 +12,38 @@ def is_file_ready(file_path):
         return False
 
 class PlaylistManager:
-    def __init__(self, playlist_dir, temp_directory, placeholder_dir, placeholder_duration):
+    def __init__(self, playlist_dir, temp_directory, placeholder_dir, placeholder_duration, clock=SYSTEM_CLOCK, on_air=None):
         self.playlist_dir = playlist_dir
         self.temp_directory = temp_directory
         self.placeholder_dir = placeholder_dir
         self.playlists = [os.path.join(playlist_dir, 'list_1.txt'), os.path.join(playlist_dir, 'list_2.txt')]
         self.current_index = 1  
         self.durations = [0, 0] 
+        self.entries = [[], []]
         self.placeholder_duration = placeholder_duration
         self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
         self.running = True
         self.processing_first_video = True
+        self.clock = clock
+        self.on_air = on_air
+        self.position_source = None
+        self.activated_at = clock.time()
+        self.last_check_time = clock.time()
+        self.placeholder_added = True
+
+    def current_position(self):
+        # Playback position used to decide when the active playlist has run out: the stream's
+        # own output position when it is known, the clock otherwise.
+        if self.position_source is not None:
+            return self.position_source()
+        return self.clock.time()
+
+    def follow_stream_position(self, position_source):
+        with self.lock:
+            self.position_source = position_source
+            self.activated_at = self.current_position()
+            self.last_check_time = self.current_position()
 
     @property
     def active_playlist(self):
@@ -31,10 +54,68 @@ class PlaylistManager:
         return self.playlists[(self.current_index + 1) % 2]
 
     def initialize_playlists(self):
-        for playlist in self.playlists:
-            if not os.path.exists(playlist):
-                with open(playlist, 'w') as f:
-                    f.write("ffconcat version 1.0\n")
+        with self.lock:
+            for index in range(len(self.playlists)):
+                self.write_playlist(index)
+
+    def playlist_pieces(self, index):
+        # One (filename, length, outpoint) tuple per `file` line of the playlist. Looped clips
+        # are listed once per loop, with the last pass cut short with an outpoint.
+        pieces = []
+        for video_filename, video_duration, loop_duration in self.entries[index]:
+            if video_duration is None:
+                video_duration = self.placeholder_duration
+            if not loop_duration:
+                pieces.append((video_filename, video_duration, None))
+                continue
+            repeats, remainder = divmod(video_duration, loop_duration)
+            pieces += [(video_filename, loop_duration, None)] * int(repeats)
+            if remainder >= 0.01:
+                pieces.append((video_filename, remainder, remainder))
+        return pieces
+
+    def render_playlist(self, index):
+        lines = ["ffconcat version 1.0\n"]
+        for video_filename, _, outpoint in self.playlist_pieces(index):
+            lines.append(f"file '{video_filename}'\n")
+            if outpoint is not None:
+                lines.append(f"outpoint {outpoint:.3f}\n")
+        if self.entries[index]:
+            other_playlist_name = os.path.basename(self.playlists[(index + 1) % 2])
+            lines.append(f"file '{other_playlist_name}'\n")
+        return ''.join(lines)
+
+    def render_resume_playlist(self):
+        # ffconcat for a standby ffmpeg taking over mid-stream: the rest of the active playlist,
+        # starting inside the clip that should be on air now, then the usual link to the other
+        # playlist. The standby reads it from a pipe, so every path is absolute.
+        with self.lock:
+            elapsed = self.current_position() - self.activated_at
+            lines = ["ffconcat version 1.0\n"]
+            start = 0
+            for video_filename, length, outpoint in self.playlist_pieces(self.current_index):
+                if start + length <= elapsed:
+                    start += length
+                    continue
+                lines.append(f"file 'file:{os.path.join(os.path.abspath(self.playlist_dir), video_filename)}'\n")
+                if start < elapsed:
+                    lines.append(f"inpoint {elapsed - start:.3f}\n")
+                if outpoint is not None:
+                    lines.append(f"outpoint {outpoint:.3f}\n")
+                start += length
+            if len(lines) == 1:
+                lines.append(f"file 'file:{os.path.abspath(self.placeholder_dir)}'\n")
+            lines.append(f"file 'file:{os.path.abspath(self.non_active_playlist)}'\n")
+            return ''.join(lines)
+
+    def write_playlist(self, index):
+        # The streaming ffmpeg may open the playlist at any moment, so it must only ever
+        # see a complete file: write a temp file next to it and rename it into place.
+        playlist_path = self.playlists[index]
+        temp_path = f"{playlist_path}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(self.render_playlist(index))
+        os.replace(temp_path, playlist_path)
 
     def add_placeholder_to_playlist(self):
         placeholder_filename = os.path.basename(self.placeholder_dir)
@@ -42,54 +123,76 @@ class PlaylistManager:
         non_active_index = (self.current_index + 1) % 2
         self.durations[non_active_index] += self.placeholder_duration 
 
+    def tick(self):
+        # One pass of the switching logic, called with the lock held. Returns how many seconds
+        # may pass before it has to run again, or None to wait for the first video.
+        current_time = self.current_position()
+        elapsed_time = current_time - self.last_check_time
+        self.last_check_time = current_time
+
+        if not self.processing_first_video:
+            self.durations[self.current_index] -= elapsed_time
+
+            if self.durations[self.current_index] <= 0 and not self.placeholder_added:
+                if self.should_add_placeholder():
+                    self.add_placeholder_to_playlist()
+                    self.placeholder_added = True
+
+            if self.durations[self.current_index] <= 0:
+                self.log_playlist_switch()
+                self.current_index = (self.current_index + 1) % 2
+                self.activated_at = current_time
+                self.durations[(self.current_index + 1) % 2] = 0
+                minutes, seconds = divmod(self.durations[self.current_index], 60)
+                print(f" --- Switched from playlist {os.path.basename(self.non_active_playlist)} to playlist {os.path.basename(self.active_playlist)} with duration of {minutes} min {seconds} sec ---\n")
+                non_active_index = (self.current_index + 1) % 2
+                self.entries[non_active_index] = []
+                self.write_playlist(non_active_index)
+                self.durations[(self.current_index + 1) % 2] = 0
+                self.placeholder_added = False
+                self.report_on_air()
+                # self.log_playlist_state()
+
+        return None if self.processing_first_video else max(0, self.durations[self.current_index])
+
+    def report_on_air(self):
+        # Hands on_air the path and start time of every clip in the playlist that just became
+        # active, so the journal holds when clips really aired rather than the estimate.
+        if self.on_air is None:
+            return
+        start_time = self.clock.time()
+        for video_filename, video_duration, _ in self.entries[self.current_index]:
+            self.on_air(os.path.join(self.temp_directory, video_filename), start_time)
+            start_time += video_duration if video_duration is not None else self.placeholder_duration
+
     def run(self):
         self.initialize_playlists()
-        last_check_time = time.time()
-        placeholder_added = True
-        while self.running:
-            with self.lock:
-                current_time = time.time()
-                elapsed_time = current_time - last_check_time
-                last_check_time = current_time
-
-                if not self.processing_first_video:
-                    self.durations[self.current_index] -= elapsed_time
-
-                    if self.durations[self.current_index] <= 0 and not placeholder_added:
-                        if self.should_add_placeholder():
-                            self.add_placeholder_to_playlist()
-                            placeholder_added = True
-
-                    if self.durations[self.current_index] <= 0:
-                        self.log_playlist_switch()
-                        self.current_index = (self.current_index + 1) % 2
-                        self.durations[(self.current_index + 1) % 2] = 0
-                        minutes, seconds = divmod(self.durations[self.current_index], 60)
-                        print(f" --- Switched from playlist {os.path.basename(self.non_active_playlist)} to playlist {os.path.basename(self.active_playlist)} with duration of {minutes} min {seconds} sec ---\n")
-                        with open(self.non_active_playlist, 'w') as f:
-                            f.write("ffconcat version 1.0\n")
-                        self.durations[(self.current_index + 1) % 2] = 0
-                        placeholder_added = False
-                        # self.log_playlist_state()
-
-            time.sleep(1)
+        with self.condition:
+            self.last_check_time = self.current_position()
+            self.placeholder_added = True
+            while self.running:
+                # Sleep until the active playlist runs out; adding a video, finishing the
+                # first video or stopping wakes the loop early.
+                self.condition.wait(self.tick())
 
     def finished_processing_first_video(self):
-        with self.lock:
+        with self.condition:
             self.processing_first_video = False
+            self.activated_at = self.current_position()
+            self.report_on_air()
+            self.condition.notify_all()
 
     def should_add_placeholder(self):
-        active_playlist_empty = self.is_playlist_empty(self.active_playlist)
-        non_active_playlist_empty = self.is_playlist_empty(self.non_active_playlist)
+        active_playlist_empty = self.is_playlist_empty(self.current_index)
+        non_active_playlist_empty = self.is_playlist_empty((self.current_index + 1) % 2)
         return active_playlist_empty and non_active_playlist_empty
 
-    def is_playlist_empty(self, playlist_path):
-        with open(playlist_path, 'r') as f:
-            lines = f.readlines()
-        
-        content_lines = [line for line in lines[1:] if not line.strip().startswith('file \'list_')]
-        
-        return len(content_lines) == 0
+    def referenced_files(self):
+        with self.lock:
+            return {video_filename for entries in self.entries for video_filename, _, _ in entries}
+
+    def is_playlist_empty(self, index):
+        return not self.entries[index]
 
     def log_playlist_state(self):
         current_time = time.strftime("%Y-%m-%d %H:%M:%S")
@@ -97,9 +200,7 @@ class PlaylistManager:
             log_file.write(f"Time: {current_time}\n")
             for i, playlist in enumerate(self.playlists):
                 log_file.write(f"Playlist {i+1} ({'Active' if i == self.current_index else 'Non-Active'}):\n")
-                with open(playlist, 'r') as playlist_file:
-                    contents = playlist_file.read()
-                    log_file.write(contents)
+                log_file.write(self.render_playlist(i))
                 log_file.write(f"Total Duration: {self.durations[i]:.2f} seconds\n\n")
             log_file.write("--------------------------------------------------\n\n")
 
@@ -109,41 +210,47 @@ class PlaylistManager:
             log_file.write(f"Time: {current_time}\n")
             log_file.write(f"--- Switching from playlist {os.path.basename(self.non_active_playlist)} to playlist {os.path.basename(self.active_playlist)} ---\n\n")
 
-    def append_to_playlist(self, video_filename):
+    def append_to_playlist(self, video_filename, video_duration=None, loop_duration=None):
         video_path = os.path.join(self.temp_directory, video_filename)
         if not is_file_ready(video_path):
             print(f"Warning: File {video_filename} is not ready to be added to the playlist.")
             return False
         
-        non_active_playlist = self.non_active_playlist
-        active_playlist_name = os.path.basename(self.active_playlist)
-
-        with open(non_active_playlist, 'r') as f:
-            lines = f.readlines()
-        if lines and lines[-1].strip() == f"file '{active_playlist_name}'":
-            lines = lines[:-1]
-        with open(non_active_playlist, 'w') as f:
-            f.writelines(lines)
-            f.write(f"file '{video_filename}'\n")
-            f.write(f"file '{active_playlist_name}'\n")
-        
+        non_active_index = (self.current_index + 1) % 2
+        self.entries[non_active_index].append((video_filename, video_duration, loop_duration))
+        self.write_playlist(non_active_index)
+
         # self.log_playlist_state()
         return True
 
-    def add_video_to_playlist(self, video_path, video_duration):
+    def add_video_to_playlist(self, video_path, video_duration, loop_duration=None):
+        # Returns the number of seconds until the clip is expected to air, or None if it was skipped.
+        start_time = time.monotonic()
+        air_in = None
         with self.lock:
             video_filename = os.path.basename(video_path)
-            if self.append_to_playlist(video_filename):
-                non_active_index = (self.current_index + 1) % 2
+            non_active_index = (self.current_index + 1) % 2
+            # durations only goes down when tick() runs, so take off the time played since then.
+            active_left = self.durations[self.current_index]
+            if not self.processing_first_video:
+                active_left -= self.current_position() - self.last_check_time
+            queued_ahead = max(0, active_left) + self.durations[non_active_index]
+            if self.append_to_playlist(video_filename, video_duration, loop_duration):
                 self.durations[non_active_index] += video_duration
+                air_in = queued_ahead
                 minutes, seconds = divmod(video_duration, 60)
                 total_min, total_sec = divmod(self.durations[non_active_index],60)
                 print(f"  - Added video to {os.path.basename(self.non_active_playlist)} playlist: {os.path.basename(video_filename)} with duration of {minutes} min {seconds} sec")
                 print(f"  - Total playlist duration is now {total_min} min {total_sec} sec")
+                self.condition.notify_all()
             else:
                 print(f"  - Skipped adding video to playlist: {os.path.basename(video_filename)} because the file is not ready.")
 
             # self.log_playlist_state()
+        PLAYLIST_APPEND_SECONDS.observe(time.monotonic() - start_time)
+        return air_in
 
     def stop(self):
-        self.running = False
\ No newline at end of file
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
\ No newline at end of file
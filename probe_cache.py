@@ -0,0 +1,292 @@
+import json
+import os
+import re
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+from metrics import PROBE_PROCESSES, PROBE_SECONDS
+
+DURATION_PATTERN = re.compile(r'Duration: (\d+):(\d{2}):(\d{2}(?:\.\d+)?)')
+INPUT_PATTERN = re.compile(r'^Input #(\d+),', re.MULTILINE)
+PROBE_BATCH_SIZE = 64
+FREEZE_PATTERN = re.compile(r'lavfi\.freezedetect\.freeze_(start|end): (\d+(?:\.\d+)?)')
+STATIC_ANALYSIS_FILTER = 'fps=5,scale=160:-2,freezedetect=n={noise}:d={min_seconds}'
+
+def probe_duration(recording_path):
+    try:
+        start_time = time.monotonic()
+        result = subprocess.run(
+            [
+                'ffprobe',
+                '-v', 'error',
+                '-show_entries', 'format=duration',
+                '-of', 'default=noprint_wrappers=1:nokey=1',
+                recording_path
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True
+        )
+        PROBE_PROCESSES.inc(kind='duration')
+        PROBE_SECONDS.observe(time.monotonic() - start_time, kind='duration')
+        return float(result.stdout)
+    except ValueError as e:
+        print(f" - Error parsing duration: {e}")
+    except subprocess.CalledProcessError as e:
+        print(f" - ffprobe error: {e.stderr}")
+    return None
+
+def probe_durations(recording_paths):
+    if len(recording_paths) == 1:
+        return {recording_paths[0]: probe_duration(recording_paths[0])}
+
+    # ffprobe only accepts a single input, but ffmpeg prints the container header of every
+    # input it is given before complaining about the missing output, so one process covers
+    # the whole batch.
+    cmd = ['ffmpeg', '-hide_banner', '-nostdin']
+    for recording_path in recording_paths:
+        cmd += ['-i', recording_path]
+    start_time = time.monotonic()
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    PROBE_PROCESSES.inc(kind='duration_batch')
+    PROBE_SECONDS.observe(time.monotonic() - start_time, kind='duration_batch')
+
+    durations = {}
+    headers = INPUT_PATTERN.split(result.stderr)[1:]
+    for index, header in zip(headers[0::2], headers[1::2]):
+        match = DURATION_PATTERN.search(header)
+        if match and int(index) < len(recording_paths):
+            hours, minutes, seconds = match.groups()
+            durations[recording_paths[int(index)]] = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+    # ffmpeg gives up at the first input it cannot open, so anything after it is probed on its own.
+    for recording_path in recording_paths:
+        if recording_path not in durations:
+            durations[recording_path] = probe_duration(recording_path)
+    return durations
+
+def probe_static_spans(recording_path, min_seconds, noise=0.003):
+    # One decode pass at 5 fps and 160 px wide through freezedetect, which logs the start and
+    # end of every span where the picture stays still for at least `min_seconds`. A span that
+    # runs to the end of the file has no end line and is closed with None.
+    try:
+        start_time = time.monotonic()
+        result = subprocess.run(
+            [
+                'ffmpeg',
+                '-hide_banner',
+                '-nostdin',
+                '-i', recording_path,
+                '-map', '0:v:0',
+                '-vf', STATIC_ANALYSIS_FILTER.format(noise=noise, min_seconds=min_seconds),
+                '-f', 'null',
+                '-'
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            text=True
+        )
+        PROBE_PROCESSES.inc(kind='static')
+        PROBE_SECONDS.observe(time.monotonic() - start_time, kind='static')
+    except OSError as e:
+        print(f" - Error analysing static scenes in {os.path.basename(recording_path)}: {e}")
+        return None
+    if result.returncode != 0:
+        return None
+
+    spans = []
+    for event, value in FREEZE_PATTERN.findall(result.stderr):
+        if event == 'start':
+            spans.append([float(value), None])
+        elif spans and spans[-1][1] is None:
+            spans[-1][1] = float(value)
+    return spans
+
+def probe_stream_info(recording_path, gop_window_seconds=5):
+    # One ffprobe call returns the stream parameters plus the packet flags of the first few
+    # seconds, which is enough to measure the keyframe interval.
+    try:
+        start_time = time.monotonic()
+        result = subprocess.run(
+            [
+                'ffprobe',
+                '-v', 'error',
+                '-read_intervals', f'%+{gop_window_seconds}',
+                '-show_entries', 'format=duration:stream=index,codec_type,codec_name,profile,level,width,height,pix_fmt,r_frame_rate,has_b_frames,sample_rate,channels:packet=stream_index,flags',
+                '-of', 'json',
+                recording_path
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True
+        )
+        PROBE_PROCESSES.inc(kind='streams')
+        PROBE_SECONDS.observe(time.monotonic() - start_time, kind='streams')
+        probe = json.loads(result.stdout)
+    except ValueError as e:
+        print(f" - Error parsing stream info: {e}")
+        return None
+
+    streams = probe.get('streams', [])
+    video = next((stream for stream in streams if stream.get('codec_type') == 'video'), None)
+    audio = next((stream for stream in streams if stream.get('codec_type') == 'audio'), None)
+
+    max_gop = None
+    if video is not None:
+        frames_since_keyframe = None
+        for packet in probe.get('packets', []):
+            if packet.get('stream_index') != video.get('index'):
+                continue
+            if 'K' in packet.get('flags', ''):
+                if frames_since_keyframe is not None:
+                    max_gop = max(max_gop or 0, frames_since_keyframe)
+                frames_since_keyframe = 1
+            elif frames_since_keyframe is not None:
+                frames_since_keyframe += 1
+        if frames_since_keyframe is not None:
+            max_gop = max(max_gop or 0, frames_since_keyframe)
+
+    try:
+        duration = float(probe.get('format', {}).get('duration'))
+    except (TypeError, ValueError):
+        duration = None
+
+    return {'video': video, 'audio': audio, 'max_gop': max_gop, 'duration': duration}
+
+class ProbeCache:
+    def __init__(self, cache_path=None, max_entries=2048):
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path, 'r') as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f" - Error loading probe cache {self.cache_path}: {e}")
+            return
+        with self.lock:
+            for file_path, entry in entries.items():
+                self.entries[file_path] = entry
+            self.evict()
+
+    def save(self):
+        # Probes only mark the cache dirty; the pipeline flushes it periodically and on
+        # shutdown. save_lock keeps two flushes from sharing the temp file.
+        if not self.cache_path:
+            return
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                contents = json.dumps(self.entries)
+                self.dirty = False
+            temp_path = f"{self.cache_path}.tmp"
+            try:
+                with open(temp_path, 'w') as f:
+                    f.write(contents)
+                os.replace(temp_path, self.cache_path)
+            except OSError as e:
+                print(f" - Error saving probe cache {self.cache_path}: {e}")
+                with self.lock:
+                    self.dirty = True
+
+    def evict(self):
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def file_key(self, file_path):
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def lookup(self, file_path, key):
+        with self.lock:
+            entry = self.entries.get(file_path)
+            if entry is None or (entry['size'], entry['mtime_ns']) != key:
+                return None
+            self.entries.move_to_end(file_path)
+            return entry
+
+    def store(self, file_path, key, **metadata):
+        with self.lock:
+            entry = self.entries.get(file_path)
+            if entry is None or (entry['size'], entry['mtime_ns']) != key:
+                entry = {'size': key[0], 'mtime_ns': key[1]}
+            entry.update(metadata)
+            self.entries[file_path] = entry
+            self.entries.move_to_end(file_path)
+            self.evict()
+            self.dirty = True
+
+    def get_duration(self, file_path):
+        return self.get_durations([file_path])[file_path]
+
+    def get_durations(self, file_paths):
+        durations = {}
+        missing = {}
+        for file_path in file_paths:
+            key = self.file_key(file_path)
+            if key is None:
+                durations[file_path] = 0
+                continue
+            entry = self.lookup(file_path, key)
+            if entry is not None and 'duration' in entry:
+                durations[file_path] = entry['duration']
+            else:
+                missing[file_path] = key
+
+        if missing:
+            missing_paths = list(missing)
+            probed = {}
+            for start in range(0, len(missing_paths), PROBE_BATCH_SIZE):
+                probed.update(probe_durations(missing_paths[start:start + PROBE_BATCH_SIZE]))
+            for file_path, key in missing.items():
+                duration = probed.get(file_path)
+                if duration is None:
+                    durations[file_path] = 0
+                    continue
+                durations[file_path] = duration
+                self.store(file_path, key, duration=duration)
+        return durations
+
+    def get_static_spans(self, file_path, min_seconds):
+        key = self.file_key(file_path)
+        if key is None:
+            return None
+        entry = self.lookup(file_path, key)
+        if entry is not None and entry.get('static_min_seconds') == min_seconds:
+            return entry['static_spans']
+
+        static_spans = probe_static_spans(file_path, min_seconds)
+        if static_spans is None:
+            return None
+        self.store(file_path, key, static_spans=static_spans, static_min_seconds=min_seconds)
+        return static_spans
+
+    def get_stream_info(self, file_path):
+        key = self.file_key(file_path)
+        if key is None:
+            return None
+        entry = self.lookup(file_path, key)
+        if entry is not None and 'stream_info' in entry:
+            return entry['stream_info']
+
+        stream_info = probe_stream_info(file_path)
+        if stream_info is None:
+            return None
+        metadata = {'stream_info': stream_info}
+        if stream_info['duration'] is not None and (entry is None or 'duration' not in entry):
+            metadata['duration'] = stream_info['duration']
+        self.store(file_path, key, **metadata)
+        return stream_info
@@ -0,0 +1,258 @@
+import argparse
+import contextlib
+import csv
+import heapq
+import itertools
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from clock import SimulatedClock
+from playlist_manager import PlaylistManager
+from scheduler import Scheduler
+from video_processing import SNAPSHOT_LOOP_SECONDS
+
+TRACE_FIELDS = ['timestamp', 'camera', 'type', 'duration']
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))
+    return ordered[index]
+
+def trace_path(timestamp, camera, file_type):
+    # Same layout as the Blink folders, so file paths stay unique per camera and second.
+    kind, extension = ('Recording', 'mp4') if file_type == 'recording' else ('Snapshot', 'jpg')
+    return os.path.join('Snapshots', timestamp.strftime('%Y/%m-%B/%d'), f"{timestamp.strftime('%H%M%S')}-Camera{camera}-{kind}.{extension}")
+
+def load_trace(path):
+    # CSV with a timestamp (ISO format), camera number, type (snapshot or recording) and,
+    # for recordings, the duration in seconds.
+    trace = []
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            duration = float(row['duration']) if row.get('duration') else None
+            trace.append((datetime.fromisoformat(row['timestamp']), int(row['camera']), row['type'], duration))
+    trace.sort()
+    return trace
+
+def save_trace(trace, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(TRACE_FIELDS)
+        for timestamp, camera, file_type, duration in trace:
+            writer.writerow([timestamp.isoformat(), camera, file_type, '' if duration is None else duration])
+
+def generate_trace(options):
+    # Independent Poisson arrivals per camera, with recordings of exponentially
+    # distributed length around --recording-seconds.
+    rng = random.Random(options.seed)
+    start = datetime(2024, 1, 1)
+    end = start + timedelta(hours=options.hours)
+    trace = []
+    for camera in range(1, options.cameras + 1):
+        for file_type, per_hour in (('snapshot', options.snapshots_per_hour), ('recording', options.recordings_per_hour)):
+            if per_hour <= 0:
+                continue
+            timestamp = start
+            while True:
+                timestamp += timedelta(seconds=rng.expovariate(per_hour / 3600))
+                if timestamp >= end:
+                    break
+                duration = round(max(1, rng.expovariate(1 / options.recording_seconds)), 1) if file_type == 'recording' else None
+                trace.append((timestamp.replace(microsecond=0), camera, file_type, duration))
+    trace.sort()
+    return trace
+
+def run_replay(trace, options):
+    work_directory = tempfile.mkdtemp(prefix='blink_replay_')
+    placeholder_path = os.path.join(work_directory, 'placeholder.mp4')
+    with open(placeholder_path, 'wb') as f:
+        f.write(b'\0')
+
+    clock = SimulatedClock(trace[0][0])
+    air_delay = timedelta(minutes=options.air_delay_minutes)
+    scheduler = Scheduler(options.duration)
+    # The air schedule comes from the playlist timeline itself: every time a playlist becomes
+    # active, on_air reports when each of its clips (and placeholders) starts.
+    timeline = []
+    playlist_manager = PlaylistManager(work_directory, work_directory, placeholder_path, options.duration, clock, lambda video_path, aired_at: timeline.append((aired_at, video_path)))
+    clip_items = {}
+    clip_durations = {}
+
+    # Count placeholders and playlist switches instead of writing playlist_log.txt.
+    placeholders = []
+    switches = []
+    add_placeholder_to_playlist = playlist_manager.add_placeholder_to_playlist
+    def counted_placeholder():
+        placeholders.append(clock.time())
+        add_placeholder_to_playlist()
+    playlist_manager.add_placeholder_to_playlist = counted_placeholder
+    playlist_manager.log_playlist_switch = lambda: switches.append(clock.time())
+
+    def stub_encode(item):
+        # Stands in for process_queue_item: writes a one byte clip and returns what the real
+        # encode would, so the playlist code sees a ready file.
+        timestamp, file_path, file_type, optional_duration = item
+        video_path = os.path.join(work_directory, os.path.basename(file_path).replace('.jpg', '.mp4'))
+        with open(video_path, 'wb') as f:
+            f.write(b'\0')
+        clip_items[video_path] = item
+        if file_type == 'snapshot':
+            return video_path, optional_duration if optional_duration is not None else options.duration, SNAPSHOT_LOOP_SECONDS
+        return video_path, optional_duration, None
+
+    def encode_cost(item):
+        if item[2] == 'snapshot':
+            return options.snapshot_encode_seconds
+        return options.recording_encode_factor * (item[3] or 0)
+
+    arrivals = [(timestamp, trace_path(timestamp, camera, file_type), file_type, duration) for timestamp, camera, file_type, duration in trace]
+    end_time = (arrivals[-1][0] + air_delay).timestamp() + options.drain_seconds
+    workers = [clock.time()] * max(1, options.workers)
+    pending = []
+    order = itertools.count()
+    next_arrival = 0
+    next_tick = None
+    started = False
+    encodes = 0
+
+    wall_start = time.monotonic()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        while True:
+            candidates = []
+            if next_arrival < len(arrivals):
+                candidates.append(arrivals[next_arrival][0].timestamp())
+            next_due = scheduler.next_time()
+            if next_due is not None:
+                candidates.append(next_due.timestamp())
+            if pending:
+                candidates.append(max(pending[0][0], pending[0][2]))
+            if next_tick is not None:
+                candidates.append(next_tick)
+            if not candidates or min(candidates) > end_time:
+                break
+            clock.advance_to(min(candidates))
+            now = clock.now()
+
+            while next_arrival < len(arrivals) and arrivals[next_arrival][0] <= now:
+                scheduler.add(*arrivals[next_arrival])
+                next_arrival += 1
+
+            while True:
+                item = scheduler.pop_due(now)
+                if item is None:
+                    break
+                worker = min(range(len(workers)), key=workers.__getitem__)
+                workers[worker] = max(clock.time(), workers[worker]) + encode_cost(item)
+                heapq.heappush(pending, ((item[0] + air_delay).timestamp(), next(order), workers[worker], item))
+                encodes += 1
+
+            while pending and pending[0][0] <= clock.time() and pending[0][2] <= clock.time():
+                _, _, _, item = heapq.heappop(pending)
+                video_path, clip_duration, loop_duration = stub_encode(item)
+                if not started:
+                    playlist_manager.initialize_playlists()
+                    playlist_manager.current_index = 1
+                playlist_manager.add_video_to_playlist(video_path, clip_duration, loop_duration)
+                clip_durations[video_path] = clip_duration
+                if not started:
+                    playlist_manager.current_index = 0
+                    playlist_manager.finished_processing_first_video()
+                    started = True
+
+            if started:
+                # Float rounding can leave a playlist a few nanoseconds from running out, so the
+                # next tick is at least a millisecond away to keep the clock moving.
+                with playlist_manager.condition:
+                    timeout = playlist_manager.tick()
+                next_tick = clock.time() + max(timeout or 0, 0.001)
+
+    wall_seconds = time.monotonic() - wall_start
+    shutil.rmtree(work_directory, ignore_errors=True)
+
+    # Only what started airing before the run ended counts; the placeholder fills the
+    # timeline between clips, so a gap is time where the playlists had nothing at all.
+    played = sorted((aired_at, video_path) for aired_at, video_path in timeline if aired_at <= clock.time())
+    aired = []
+    gaps = []
+    previous_end = None
+    for aired_at, video_path in played:
+        length = min(clip_durations.get(video_path, options.duration), clock.time() - aired_at)
+        if previous_end is not None and aired_at - previous_end > 0.01:
+            gaps.append(aired_at - previous_end)
+        previous_end = aired_at + length
+        if video_path in clip_items:
+            timestamp, file_path, file_type, _ = clip_items[video_path]
+            aired.append((timestamp, aired_at, length, file_type, file_path))
+    latencies = [air_at - timestamp.timestamp() for timestamp, air_at, _, _, _ in aired]
+    simulated_seconds = clock.time() - trace[0][0].timestamp()
+
+    if options.schedule_output:
+        with open(options.schedule_output, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['file', 'type', 'timestamp', 'air_at', 'duration'])
+            for timestamp, air_at, clip_duration, file_type, file_path in aired:
+                writer.writerow([os.path.basename(file_path), file_type, timestamp.isoformat(), datetime.fromtimestamp(air_at).isoformat(), clip_duration])
+
+    return {
+        'files': len(arrivals),
+        'encodes': encodes,
+        'clips_aired': len(aired),
+        'dropped': len(arrivals) - encodes,
+        'not_aired_by_end': encodes - len(aired),
+        'aired_seconds': round(sum(entry[2] for entry in aired), 3),
+        'placeholders': len(placeholders),
+        'placeholder_seconds': len(placeholders) * options.duration,
+        'playlist_switches': len(switches),
+        'gaps': {
+            'count': len(gaps),
+            'total_seconds': round(sum(gaps), 3),
+            'max_seconds': round(max(gaps), 3) if gaps else None,
+        },
+        'air_latency_seconds': {
+            'p50': percentile(latencies, 0.50),
+            'p90': percentile(latencies, 0.90),
+            'p99': percentile(latencies, 0.99),
+            'max': max(latencies) if latencies else None,
+        },
+        'simulated_seconds': round(simulated_seconds, 3),
+        'wall_seconds': round(wall_seconds, 3),
+        'speedup': round(simulated_seconds / wall_seconds) if wall_seconds else None,
+    }
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay a file-arrival trace through the scheduler and playlist manager on a simulated clock.")
+    parser.add_argument('--trace', help="CSV trace with timestamp,camera,type,duration columns; generated when omitted")
+    parser.add_argument('--save-trace', help="Write the generated trace to this CSV file")
+    parser.add_argument('--hours', type=float, default=24, help="Length of the generated trace")
+    parser.add_argument('--cameras', type=int, default=3, help="Cameras in the generated trace")
+    parser.add_argument('--snapshots-per-hour', type=float, default=6, help="Snapshots per camera per hour")
+    parser.add_argument('--recordings-per-hour', type=float, default=4, help="Recordings per camera per hour")
+    parser.add_argument('--recording-seconds', type=float, default=20, help="Mean recording length")
+    parser.add_argument('--duration', type=int, default=600, help="Snapshot duration budget, as in settings.json")
+    parser.add_argument('--air-delay-minutes', type=float, default=0, help="Air delay, as in settings.json")
+    parser.add_argument('--workers', type=int, default=2, help="Concurrent encodes")
+    parser.add_argument('--snapshot-encode-seconds', type=float, default=0.5, help="Simulated encode time of a snapshot")
+    parser.add_argument('--recording-encode-factor', type=float, default=0.1, help="Simulated encode time per second of recording")
+    parser.add_argument('--drain-seconds', type=float, default=3600, help="Simulated time to keep running after the last file")
+    parser.add_argument('--schedule-output', help="Write the air schedule to this CSV file")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json-output', help="Also write the report to this JSON file")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    options = parse_args()
+    trace = load_trace(options.trace) if options.trace else generate_trace(options)
+    if options.save_trace:
+        save_trace(trace, options.save_trace)
+    report = run_replay(trace, options)
+    print(json.dumps(report, indent=2))
+    if options.json_output:
+        with open(options.json_output, 'w') as f:
+            json.dump(report, f, indent=2)
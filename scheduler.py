@@ -0,0 +1,209 @@
+import bisect
+import heapq
+import os
+import threading
+from datetime import timedelta
+
+class QueueItem:
+    __slots__ = ('timestamp', 'file_path', 'file_type', 'duration', 'gap')
+
+    def __init__(self, timestamp, file_path, file_type, duration):
+        self.timestamp = timestamp
+        self.file_path = file_path
+        self.file_type = file_type
+        self.duration = duration
+        self.gap = 0
+
+    @property
+    def key(self):
+        return (self.timestamp, self.file_path)
+
+    def as_tuple(self):
+        return (self.timestamp, self.file_path, self.file_type, self.duration)
+
+class Scheduler:
+    # A snapshot airs for whatever is left of `duration` once the recordings between it and the
+    # previous snapshot have played (its "gap"). Items are kept in a heap for popping plus one
+    # sorted key list per file type, so an insert only touches the snapshots on either side of it.
+    # Recordings that were popped before the next snapshot arrived are carried in `pending_gap`.
+    def __init__(self, duration):
+        self.duration = duration
+        self.pending_gap = 0
+        # Recordings whose duration may still change (see expect_update), and those of them
+        # already popped into pending_gap. Both only hold recordings with an update pending.
+        self.awaiting_update = set()
+        self.carried_recordings = {}
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.woken = False
+        self.heap = []
+        self.items = {}
+        self.snapshot_keys = []
+        self.recording_keys = []
+
+    def __len__(self):
+        with self.lock:
+            return len(self.heap)
+
+    def __contains__(self, file_path):
+        with self.lock:
+            return file_path in self.items
+
+    def add(self, timestamp, file_path, file_type, recording_duration=None):
+        with self.lock:
+            if file_path in self.items:
+                return False
+            item = QueueItem(timestamp, file_path, file_type, recording_duration if file_type == 'recording' else None)
+            if file_type == 'recording':
+                self.add_recording(item)
+            else:
+                self.add_snapshot(item)
+            self.items[file_path] = item
+            heapq.heappush(self.heap, item.key)
+            self.woken = True
+            self.condition.notify_all()
+            return True
+
+    def add_many(self, entries):
+        # Bulk ingest for startup scans: one heapify, one merge of each sorted key list and
+        # a single pass to recompute every snapshot gap, instead of one insert per file.
+        with self.lock:
+            new_items = []
+            for timestamp, file_path, file_type, recording_duration in entries:
+                if file_path in self.items:
+                    continue
+                item = QueueItem(timestamp, file_path, file_type, recording_duration if file_type == 'recording' else None)
+                self.items[file_path] = item
+                new_items.append(item)
+            if not new_items:
+                return 0
+
+            self.heap.extend(item.key for item in new_items)
+            heapq.heapify(self.heap)
+            self.recording_keys = sorted(self.recording_keys + [item.key for item in new_items if item.file_type == 'recording'])
+            self.snapshot_keys = sorted(self.snapshot_keys + [item.key for item in new_items if item.file_type == 'snapshot'])
+
+            gap = self.pending_gap
+            for _, file_path in heapq.merge(self.recording_keys, self.snapshot_keys):
+                item = self.items[file_path]
+                if item.file_type == 'recording':
+                    gap += item.duration
+                else:
+                    item.gap = gap
+                    self.adjust_snapshot(item)
+                    gap = 0
+
+            self.woken = True
+            self.condition.notify_all()
+            return len(new_items)
+
+    def add_recording(self, item):
+        bisect.insort(self.recording_keys, item.key)
+        next_snapshot = self.snapshot_after(item.key)
+        if next_snapshot is not None:
+            next_snapshot.gap += item.duration
+            self.adjust_snapshot(next_snapshot)
+            print(f"  - Recording ({os.path.basename(item.file_path)}) has a duration of {item.duration}s. Duration for next snapshot is {next_snapshot.duration}s")
+        else:
+            print(f"  - Recording ({os.path.basename(item.file_path)}) has a duration of {item.duration}s")
+
+    def add_snapshot(self, item):
+        index = bisect.bisect_left(self.snapshot_keys, item.key)
+        previous_key = self.snapshot_keys[index - 1] if index > 0 else None
+        start = bisect.bisect_right(self.recording_keys, previous_key) if previous_key is not None else 0
+        end = bisect.bisect_left(self.recording_keys, item.key)
+        item.gap = sum(self.items[file_path].duration for _, file_path in self.recording_keys[start:end])
+        if previous_key is None:
+            item.gap += self.pending_gap
+        self.adjust_snapshot(item)
+
+        next_snapshot = self.snapshot_after(item.key)
+        if next_snapshot is not None:
+            next_snapshot.gap = max(0, next_snapshot.gap - item.gap)
+            self.adjust_snapshot(next_snapshot)
+        self.snapshot_keys.insert(index, item.key)
+        print(f"  - Snapshot ({os.path.basename(item.file_path)}) has a duration of {item.duration}s")
+
+    def snapshot_after(self, key):
+        index = bisect.bisect_right(self.snapshot_keys, key)
+        if index < len(self.snapshot_keys):
+            return self.items[self.snapshot_keys[index][1]]
+        return None
+
+    def adjust_snapshot(self, item):
+        item.duration = self.duration - item.gap
+
+    def expect_update(self, file_path):
+        with self.lock:
+            self.awaiting_update.add(file_path)
+
+    def update_duration(self, file_path, recording_duration):
+        # A recording turned out shorter (or longer) than first budgeted: move the difference
+        # onto the snapshot after it, including for a recording that was already popped but
+        # is still carried in pending_gap. Each expected update arrives once.
+        with self.lock:
+            self.awaiting_update.discard(file_path)
+            if file_path in self.carried_recordings:
+                difference = recording_duration - self.carried_recordings.pop(file_path)
+                self.pending_gap += difference
+                next_snapshot = self.items[self.snapshot_keys[0][1]] if self.snapshot_keys else None
+                if next_snapshot is not None:
+                    next_snapshot.gap += difference
+                    self.adjust_snapshot(next_snapshot)
+                return True
+            item = self.items.get(file_path)
+            if item is None or item.file_type != 'recording':
+                return False
+            difference = recording_duration - item.duration
+            item.duration = recording_duration
+            next_snapshot = self.snapshot_after(item.key)
+            if next_snapshot is not None:
+                next_snapshot.gap += difference
+                self.adjust_snapshot(next_snapshot)
+            return True
+
+    def next_time(self):
+        with self.lock:
+            return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now):
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                key = heapq.heappop(self.heap)
+                item = self.items.pop(key[1])
+                keys = self.recording_keys if item.file_type == 'recording' else self.snapshot_keys
+                del keys[bisect.bisect_left(keys, key)]
+                if item.file_type == 'recording':
+                    self.pending_gap += item.duration
+                    if item.file_path in self.awaiting_update:
+                        self.carried_recordings[item.file_path] = item.duration
+                    return item.as_tuple()
+                self.pending_gap = 0
+                # Updates for recordings carried so far now come too late to matter.
+                self.awaiting_update.difference_update(self.carried_recordings)
+                self.carried_recordings.clear()
+                if item.duration <= 0:
+                    print(f"  - Dropped snapshot ({os.path.basename(item.file_path)}) as recordings used up its duration")
+                    continue
+                return item.as_tuple()
+        return None
+
+    def wake(self):
+        with self.condition:
+            self.woken = True
+            self.condition.notify_all()
+
+    def wait(self, now, timeout=None):
+        # Sleeps until the head of the queue is due, a new item is added, `wake` is called
+        # or `timeout` seconds pass, whichever comes first.
+        with self.condition:
+            if not self.woken:
+                if self.heap:
+                    due_in = max(0, (self.heap[0][0] - now) / timedelta(seconds=1))
+                    timeout = due_in if timeout is None else min(timeout, due_in)
+                self.condition.wait(timeout)
+            self.woken = False
+
+    def queued_items(self):
+        with self.lock:
+            return sorted(item.as_tuple() for item in self.items.values())
@@ -0,0 +1,152 @@
+import math
+import os
+import shutil
+import subprocess
+import threading
+import time
+from collections import deque
+from streaming_server import output_args
+from metrics import STREAM_RESTARTS
+
+PLACEHOLDER_CHUNK_SECONDS = 5
+PIPE_CHUNK_BYTES = 64 * 1024
+
+class SegmentFeeder:
+    # Alternative to the ffconcat playlist pair: one long-lived ffmpeg reads MPEG-TS from
+    # its stdin and pushes it to the stream URL, while this class remuxes each clip to
+    # MPEG-TS in schedule order and writes it into that pipe. When nothing is queued it
+    # feeds short chunks of the placeholder, so the output never stops. It exposes the same
+    # add_video_to_playlist/referenced_files interface as PlaylistManager.
+    def __init__(self, stream_url, temp_directory, placeholder_path, placeholder_duration, on_air=None):
+        self.stream_url = stream_url
+        self.temp_directory = temp_directory
+        self.placeholder_path = placeholder_path
+        self.placeholder_duration = placeholder_duration
+        self.on_air = on_air
+        self.clips = deque()
+        self.queued_seconds = 0
+        self.current_filename = None
+        self.segment_ends_at = time.time()
+        self.offset = 0
+        self.output_process = None
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        print(f" - Started segment feeder streaming to {self.stream_url}")
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.output_process is not None:
+            self.output_process.terminate()
+            try:
+                self.output_process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.output_process.kill()
+        if self.thread is not None:
+            self.thread.join()
+
+    def add_video_to_playlist(self, video_path, video_duration, loop_duration=None):
+        if not os.path.exists(video_path) or os.path.getsize(video_path) == 0:
+            print(f"  - Skipped adding video to stream: {os.path.basename(video_path)} because the file is not ready.")
+            return None
+        with self.condition:
+            air_in = max(0, self.segment_ends_at - time.time()) + self.queued_seconds
+            self.clips.append((video_path, video_duration, loop_duration))
+            self.queued_seconds += video_duration
+            self.condition.notify_all()
+        minutes, seconds = divmod(video_duration, 60)
+        print(f"  - Queued video for streaming: {os.path.basename(video_path)} with duration of {minutes} min {seconds} sec")
+        return air_in
+
+    def referenced_files(self):
+        with self.lock:
+            referenced = {os.path.basename(video_path) for video_path, _, _ in self.clips}
+            if self.current_filename is not None:
+                referenced.add(self.current_filename)
+            return referenced
+
+    def ensure_output_process(self):
+        if self.output_process is not None and self.output_process.poll() is None:
+            return self.output_process
+        if self.output_process is not None:
+            print(f"FFmpeg output process exited with code {self.output_process.returncode}, restarting it")
+            STREAM_RESTARTS.inc()
+        cmd = [
+            'ffmpeg',
+            '-re',
+            '-f', 'mpegts',
+            '-i', 'pipe:0',
+            '-c', 'copy',
+            *output_args(self.stream_url)
+        ]
+        with open('ffmpeg_streaming_log.txt', 'w') as log_file:
+            self.output_process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=log_file, stderr=log_file)
+        self.offset = 0
+        return self.output_process
+
+    def feed_segment(self, video_path, duration, loop_duration=None):
+        output_process = self.ensure_output_process()
+        cmd = ['ffmpeg', '-nostdin', '-v', 'error']
+        if loop_duration:
+            cmd += ['-stream_loop', str(max(0, math.ceil(duration / loop_duration) - 1))]
+        cmd += [
+            '-i', video_path,
+            '-t', f'{duration:.3f}',
+            '-map', '0:v:0',
+            '-map', '0:a:0?',
+            '-c', 'copy',
+            '-output_ts_offset', f'{self.offset:.3f}',
+            '-f', 'mpegts',
+            'pipe:1'
+        ]
+        with open('ffmpeg_segment_log.txt', 'a') as log_file:
+            segment_process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=log_file)
+        try:
+            shutil.copyfileobj(segment_process.stdout, output_process.stdin, PIPE_CHUNK_BYTES)
+            output_process.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            segment_process.kill()
+            segment_process.wait()
+            return False
+        finally:
+            segment_process.stdout.close()
+        if segment_process.wait() != 0:
+            print(f"  - Error remuxing {os.path.basename(video_path)} for streaming")
+            return True
+        self.offset += duration
+        return True
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.running:
+                    break
+                if self.clips:
+                    video_path, duration, loop_duration = self.clips.popleft()
+                    self.queued_seconds -= duration
+                else:
+                    video_path, duration, loop_duration = self.placeholder_path, min(PLACEHOLDER_CHUNK_SECONDS, self.placeholder_duration), None
+                self.current_filename = os.path.basename(video_path)
+                self.segment_ends_at = time.time() + duration
+
+            if self.on_air is not None and video_path != self.placeholder_path:
+                self.on_air(video_path, time.time())
+            if not self.feed_segment(video_path, duration, loop_duration):
+                # The output ffmpeg went away mid-segment: put the clip back and let the next
+                # call restart the output process.
+                with self.condition:
+                    if video_path != self.placeholder_path:
+                        self.clips.appendleft((video_path, duration, loop_duration))
+                        self.queued_seconds += duration
+                time.sleep(1)
+
+        with self.lock:
+            self.current_filename = None
@@ -1,22 +1,213 @@
 import os
 import subprocess
+import threading
+import time
+from metrics import STREAM_RESTARTS, STREAM_OUTAGE_SECONDS
 
-def start_streaming_server(playlist_path, stream_url):
+STALL_TIMEOUT_SECONDS = 10
+PROGRESS_PERIOD_SECONDS = 0.5
+STABLE_RUN_SECONDS = 60
+RESTART_BACKOFF_SECONDS = 1
+MAX_RESTART_BACKOFF_SECONDS = 30
+
+def output_args(stream_url, output_format='rtsp'):
+    # The stream goes out over RTSP (rtsp:// or rtsps://). The benchmark asks for another
+    # format explicitly, e.g. mpegts to a local file or udp:// URL.
+    if output_format == 'rtsp':
+        return ['-rtsp_transport', 'tcp', '-f', 'rtsp', stream_url]
+    return ['-y', '-f', output_format, stream_url]
+
+def streaming_command(playlist_input, stream_url, progress=False, output_format='rtsp'):
+    cmd = ['ffmpeg']
+    if progress:
+        cmd += ['-nostats', '-progress', 'pipe:1']
+    cmd += [
+        '-re',
+        '-f', 'concat',
+        '-safe', '0',
+        '-i', playlist_input,
+        '-c', 'copy',
+        *output_args(stream_url, output_format)
+    ]
+    return cmd
+
+def start_streaming_server(playlist_path, stream_url, output_format='rtsp'):
 
     if not os.path.exists(playlist_path):
         raise RuntimeError(f"ERROR - Playlist file not found at {playlist_path}")
 
-    cmd = [
-        'ffmpeg',
-        '-re',  
-        '-f', 'concat',  
-        '-safe', '0', 
-        '-i', playlist_path, 
-        '-c', 'copy',  
-        '-rtsp_transport', 'tcp',  
-        '-f', 'rtsp',  
-        stream_url  
-    ]
+    cmd = streaming_command(playlist_path, stream_url, output_format=output_format)
     with open('ffmpeg_streaming_log.txt', 'w') as log_file:
         process = subprocess.Popen(cmd, stdout=log_file, stderr=log_file)
-    return process
\ No newline at end of file
+    return process
+
+class StreamingProcess:
+    # One streaming ffmpeg and what its -progress output last reported.
+    def __init__(self, process, on_change):
+        self.process = process
+        self.started_at = time.monotonic()
+        self.last_progress = time.monotonic()
+        self.out_time = 0
+        self.out_time_at = None
+        self.first_output_at = None
+        self.on_change = on_change
+        threading.Thread(target=self.read_progress, daemon=True).start()
+
+    def read_progress(self):
+        for line in self.process.stdout:
+            key, _, value = line.strip().partition('=')
+            if key == 'out_time_us' and value.isdigit():
+                self.out_time = int(value) / 1_000_000
+                self.out_time_at = time.monotonic()
+                if self.out_time > 0 and self.first_output_at is None:
+                    self.first_output_at = time.monotonic()
+                    self.on_change()
+            elif key == 'progress':
+                self.last_progress = time.monotonic()
+        self.process.wait()
+        self.on_change()
+
+    def position(self):
+        # Seconds of media written so far. -progress only reports every half second, so the
+        # time since the last report is added on, capped at one reporting period.
+        if self.out_time_at is None:
+            return self.out_time
+        return self.out_time + min(time.monotonic() - self.out_time_at, PROGRESS_PERIOD_SECONDS)
+
+    def stalled(self):
+        return time.monotonic() - self.last_progress > STALL_TIMEOUT_SECONDS
+
+    def kill(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+class StreamSupervisor:
+    # Runs the streaming ffmpeg and a warmed standby. The standby is already started and
+    # blocked reading its playlist from stdin; when the active process exits or stops
+    # reporting progress, the standby is handed the rest of the active playlist from the
+    # current position and takes over, and a new standby is started behind it.
+    def __init__(self, playlist_manager, stream_url):
+        self.playlist_manager = playlist_manager
+        self.stream_url = stream_url
+        self.active = None
+        self.standby = None
+        self.failures = 0
+        self.retry_at = 0
+        self.outage_started_at = None
+        self.position_base = 0
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        playlist_path = self.playlist_manager.active_playlist
+        if not os.path.exists(playlist_path):
+            raise RuntimeError(f"ERROR - Playlist file not found at {playlist_path}")
+        with open('ffmpeg_streaming_log.txt', 'w') as log_file:
+            process = subprocess.Popen(
+                streaming_command(playlist_path, self.stream_url, progress=True),
+                stdout=subprocess.PIPE, stderr=log_file, text=True
+            )
+        self.active = StreamingProcess(process, self.notify)
+        self.spawn_standby()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+        for streaming_process in (self.active, self.standby):
+            if streaming_process is not None:
+                streaming_process.process.terminate()
+                try:
+                    streaming_process.process.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    streaming_process.kill()
+
+    def stream_position(self):
+        # Seconds of media the stream has output across every process, which the playlist
+        # manager uses as its clock. It stands still while the stream is down, and a standby
+        # resumes from where it stopped.
+        active = self.active
+        return self.position_base + (active.position() if active is not None else 0)
+
+    def notify(self):
+        with self.condition:
+            self.condition.notify_all()
+
+    def spawn_standby(self):
+        # The standby loads ffmpeg and blocks on its stdin, so it does not connect to the
+        # stream URL until it is given a playlist.
+        with open('ffmpeg_streaming_log.txt', 'a') as log_file:
+            process = subprocess.Popen(
+                ['ffmpeg', '-protocol_whitelist', 'file,pipe', *streaming_command('pipe:0', self.stream_url, progress=True)[1:]],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=log_file, text=True
+            )
+        self.standby = StreamingProcess(process, self.notify)
+
+    def backoff(self):
+        # The first failure fails over at once; repeated failures back off exponentially, so
+        # a stream URL that is down does not get a new ffmpeg every second.
+        if self.failures <= 1:
+            return 0
+        return min(MAX_RESTART_BACKOFF_SECONDS, RESTART_BACKOFF_SECONDS * 2 ** (self.failures - 2))
+
+    def handle_failure(self):
+        failed, self.active = self.active, None
+        failed.kill()
+        self.position_base += failed.out_time
+        if self.outage_started_at is None:
+            self.outage_started_at = failed.last_progress
+        if time.monotonic() - failed.started_at >= STABLE_RUN_SECONDS:
+            self.failures = 0
+        self.failures += 1
+        self.retry_at = time.monotonic() + self.backoff()
+        STREAM_RESTARTS.inc()
+        print(f"\nERROR - FFmpeg streaming process stopped (exit code {failed.process.returncode}) after {failed.out_time:.1f}s of output. Failing over in {self.backoff()} seconds...\n")
+
+    def promote_standby(self):
+        standby, self.standby = self.standby, None
+        try:
+            standby.process.stdin.write(self.playlist_manager.render_resume_playlist())
+            standby.process.stdin.close()
+        except (BrokenPipeError, OSError) as e:
+            print(f"  - Error handing the playlist to the standby: {e}")
+            standby.kill()
+            return False
+        standby.started_at = standby.last_progress = time.monotonic()
+        self.active = standby
+        return True
+
+    def run(self):
+        with self.condition:
+            while self.running:
+                active = self.active
+                if active is not None and active.first_output_at is not None and self.outage_started_at is not None:
+                    outage = max(0, active.first_output_at - self.outage_started_at)
+                    STREAM_OUTAGE_SECONDS.observe(outage)
+                    print(f" - Stream restored after {outage:.2f} seconds")
+                    self.outage_started_at = None
+
+                if active is not None and (active.process.poll() is not None or active.stalled()):
+                    self.handle_failure()
+
+                if self.standby is not None and self.standby.process.poll() is not None:
+                    print(f"  - Standby ffmpeg exited with code {self.standby.process.returncode}")
+                    self.standby = None
+                    self.failures += 1
+                    self.retry_at = time.monotonic() + self.backoff()
+
+                if time.monotonic() >= self.retry_at:
+                    if self.standby is None:
+                        self.spawn_standby()
+                    if self.active is None and not self.promote_standby():
+                        self.failures += 1
+                        self.retry_at = time.monotonic() + self.backoff()
+
+                self.condition.wait(max(0.1, min(1, self.retry_at - time.monotonic())))
@@ -0,0 +1,107 @@
+import multiprocessing
+import os
+import shutil
+import time
+from multiprocessing.connection import wait
+from encoders import select_encoder
+
+RESTART_BACKOFF_SECONDS = 2
+MAX_RESTART_BACKOFF_SECONDS = 60
+STABLE_RUN_SECONDS = 300
+
+def camera_path(path, camera):
+    root, extension = os.path.splitext(path)
+    return f"{root}_camera{camera}{extension}"
+
+def camera_settings(settings, camera):
+    # Each camera gets its own stream, playlists, temp directory, journal, probe cache and
+    # metrics endpoint, so the pipelines never share state between processes.
+    overrides = dict(settings)
+    stream_url_template = settings.get('camera_stream_url', settings['stream_url'] + '/camera{camera}')
+    overrides['stream_url'] = stream_url_template.format(camera=camera)
+    overrides['temp_directory'] = os.path.join(settings['temp_directory'], f'camera{camera}')
+    overrides['playlist_dir'] = os.path.join(settings['playlist_dir'], f'camera{camera}')
+    overrides['journal_path'] = camera_path(settings.get('journal_path', 'journal.db'), camera)
+    overrides['probe_cache_path'] = camera_path(settings.get('probe_cache_path', 'probe_cache.json'), camera)
+    if settings.get('metrics_snapshot_path', 'metrics.json'):
+        overrides['metrics_snapshot_path'] = camera_path(settings.get('metrics_snapshot_path', 'metrics.json'), camera)
+    metrics_port = settings.get('metrics_port', 9101)
+    overrides['metrics_port'] = metrics_port + camera if metrics_port else 0
+    for directory in (overrides['temp_directory'], overrides['playlist_dir']):
+        os.makedirs(directory, exist_ok=True)
+    # Playlists name the placeholder by its file name in temp_directory, so each camera
+    # directory needs its own copy.
+    placeholder_path = os.path.join(overrides['temp_directory'], os.path.basename(settings['placeholder_dir']))
+    if not os.path.exists(placeholder_path):
+        shutil.copyfile(settings['placeholder_dir'], placeholder_path)
+    overrides['placeholder_dir'] = placeholder_path
+    return overrides
+
+class Supervisor:
+    # Runs one pipeline process per camera and restarts any that exit. The processes share
+    # one encoder choice and one semaphore of encode slots, so max_concurrent_encodes bounds
+    # the encodes running on the whole machine rather than per camera.
+    def __init__(self, settings, run_pipeline):
+        self.settings = settings
+        self.run_pipeline = run_pipeline
+        self.cameras = [int(camera) for camera in settings['cameras']]
+        self.encode_slots = multiprocessing.BoundedSemaphore(max(1, int(settings.get('max_concurrent_encodes', 2))))
+        self.encoder = select_encoder(
+            settings.get('encoder', 'auto'),
+            settings.get('ffmpeg_vaapi_device', '/dev/dri/renderD128'),
+            settings.get('encoder_presets'),
+            settings.get('encoder_cache_path', 'encoder_cache.json')
+        )
+        self.processes = {}
+        self.started_at = {}
+        self.restarts = {camera: 0 for camera in self.cameras}
+        self.restart_at = {}
+
+    def start_camera(self, camera):
+        process = multiprocessing.Process(
+            target=self.run_pipeline,
+            args=(camera_settings(self.settings, camera), self.encoder, camera, self.encode_slots),
+            name=f'camera{camera}'
+        )
+        process.start()
+        self.processes[camera] = process
+        self.started_at[camera] = time.monotonic()
+        print(f" - Started pipeline for camera {camera} (pid {process.pid})")
+
+    def check_processes(self):
+        now = time.monotonic()
+        for camera, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            del self.processes[camera]
+            if now - self.started_at[camera] >= STABLE_RUN_SECONDS:
+                self.restarts[camera] = 0
+            backoff = min(MAX_RESTART_BACKOFF_SECONDS, RESTART_BACKOFF_SECONDS * 2 ** self.restarts[camera])
+            self.restarts[camera] += 1
+            self.restart_at[camera] = now + backoff
+            print(f"\nERROR - Pipeline for camera {camera} exited with code {process.exitcode}. Restarting in {backoff} seconds...\n")
+
+        for camera, restart_time in list(self.restart_at.items()):
+            if now >= restart_time:
+                del self.restart_at[camera]
+                self.start_camera(camera)
+
+    def run(self):
+        for camera in self.cameras:
+            self.start_camera(camera)
+        try:
+            while True:
+                timeout = max(0, min(self.restart_at.values()) - time.monotonic()) if self.restart_at else None
+                wait([process.sentinel for process in self.processes.values()], timeout)
+                self.check_processes()
+        except KeyboardInterrupt:
+            # Ctrl+C reaches the camera processes as well; give them time to shut down cleanly.
+            for process in self.processes.values():
+                process.join(timeout=30)
+                if process.is_alive():
+                    process.terminate()
+                    process.join()
+            print("\nAll camera pipelines stopped due to KeyboardInterrupt")
+
+def supervise(settings, run_pipeline):
+    Supervisor(settings, run_pipeline).run()
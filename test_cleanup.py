@@ -0,0 +1,58 @@
+import os
+import tempfile
+import unittest
+
+from cleanup import TempFileEvictor
+
+NOW = 1_700_000_000
+HOUR = 3600
+
+class TempFileEvictorTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def add_clip(self, evictor, filename, size, age, aired_at=None):
+        with open(os.path.join(self.directory.name, filename), 'wb') as f:
+            f.write(b'\0' * size)
+        evictor.add_clip(filename, size, NOW - age)
+        if aired_at is not None:
+            evictor.mark_aired(filename, aired_at)
+
+    def remaining(self):
+        return sorted(os.listdir(self.directory.name))
+
+    def test_referenced_clips_are_never_evicted(self):
+        evictor = TempFileEvictor(self.directory.name, [], min_age_minutes=60, max_bytes=10)
+        self.add_clip(evictor, 'old.mp4', 100, 3 * HOUR, aired_at=NOW - 2 * HOUR)
+        self.add_clip(evictor, 'other.mp4', 100, 3 * HOUR, aired_at=NOW - 2 * HOUR)
+
+        removed = evictor.evict({'old.mp4'}, NOW)
+        self.assertEqual(removed, ['other.mp4'])
+        self.assertEqual(self.remaining(), ['old.mp4'])
+        self.assertTrue(evictor.over_budget())
+
+    def test_age_limit_applies_before_the_budget(self):
+        evictor = TempFileEvictor(self.directory.name, [], min_age_minutes=60, max_bytes=250)
+        self.add_clip(evictor, 'old.mp4', 100, 2 * HOUR)
+        self.add_clip(evictor, 'aired.mp4', 100, 10 * 60, aired_at=NOW - 5 * 60)
+        self.add_clip(evictor, 'new.mp4', 100, 5 * 60)
+
+        removed = evictor.evict(set(), NOW)
+        self.assertEqual(removed, ['old.mp4'])
+        self.assertEqual(self.remaining(), ['aired.mp4', 'new.mp4'])
+        self.assertEqual(evictor.total_bytes, 200)
+
+    def test_budget_removes_clips_that_aired_longest_ago_first(self):
+        evictor = TempFileEvictor(self.directory.name, [], min_age_minutes=60, max_bytes=150)
+        self.add_clip(evictor, 'second.mp4', 100, 30 * 60, aired_at=NOW - 10 * 60)
+        self.add_clip(evictor, 'first.mp4', 100, 30 * 60, aired_at=NOW - 20 * 60)
+        self.add_clip(evictor, 'third.mp4', 100, 30 * 60, aired_at=NOW - 60)
+        self.add_clip(evictor, 'upcoming.mp4', 100, 30 * 60, aired_at=NOW + 60)
+
+        removed = evictor.evict(set(), NOW)
+        self.assertEqual(removed, ['first.mp4', 'second.mp4', 'third.mp4'])
+        self.assertEqual(self.remaining(), ['upcoming.mp4'])
+
+if __name__ == '__main__':
+    unittest.main()
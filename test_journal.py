@@ -0,0 +1,57 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from journal import Journal
+
+START = datetime(2024, 1, 1, 12, 0, 0)
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.journal = Journal(os.path.join(directory.name, 'journal.db'))
+        self.addCleanup(self.journal.close)
+
+    def add_clip(self, name, seconds, state):
+        source_path = f'{name}.jpg'
+        output_path = f'/temp/{name}.mp4'
+        self.journal.record_ingested([(START + timedelta(seconds=seconds), source_path, 'snapshot')])
+        if state != 'ingested':
+            self.journal.record_encoded(source_path, output_path, 10, 2)
+        return source_path, output_path
+
+    def test_clips_aired_in_the_future_are_resumed_and_aired_clips_are_not(self):
+        now = START + timedelta(minutes=5)
+        self.add_clip('ingested', 0, 'ingested')
+        encoded, encoded_output = self.add_clip('encoded', 1, 'encoded')
+        upcoming, upcoming_output = self.add_clip('upcoming', 2, 'encoded')
+        aired, _ = self.add_clip('aired', 3, 'encoded')
+        self.journal.record_aired(upcoming, (now + timedelta(seconds=30)).timestamp())
+        self.journal.record_aired(aired, (now - timedelta(seconds=30)).timestamp())
+
+        resumable = self.journal.resumable_clips(START - timedelta(minutes=1), now)
+        self.assertEqual(resumable, [(encoded, encoded_output, 10, 2), (upcoming, upcoming_output, 10, 2)])
+
+    def test_real_air_time_replaces_the_estimate(self):
+        now = START + timedelta(minutes=5)
+        source_path, output_path = self.add_clip('clip', 0, 'encoded')
+        self.journal.record_aired(source_path, (now + timedelta(minutes=1)).timestamp())
+
+        self.assertEqual(self.journal.record_clip_aired(output_path, (now - timedelta(seconds=1)).timestamp()), source_path)
+        self.assertIsNone(self.journal.record_clip_aired('/temp/placeholder.mp4', now.timestamp()))
+        self.assertEqual(self.journal.resumable_clips(START - timedelta(minutes=1), now), [])
+
+    def test_processed_paths_skip_only_encoded_clips_in_the_window(self):
+        self.add_clip('old', -120, 'encoded')
+        self.add_clip('ingested', 0, 'ingested')
+        encoded, _ = self.add_clip('encoded', 1, 'encoded')
+        aired, _ = self.add_clip('aired', 2, 'encoded')
+        self.journal.record_aired(aired, START.timestamp())
+
+        processed = self.journal.processed_paths(START - timedelta(minutes=1))
+        self.assertEqual(processed, {encoded: START + timedelta(seconds=1), aired: START + timedelta(seconds=2)})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import unittest
+from datetime import datetime, timedelta
+
+from scheduler import Scheduler
+
+START = datetime(2024, 1, 1, 12, 0, 0)
+
+class SchedulerTest(unittest.TestCase):
+    def test_recording_popped_before_next_snapshot_reduces_it(self):
+        scheduler = Scheduler(600)
+        scheduler.add(START, 'recording.mp4', 'recording', 500)
+        self.assertEqual(scheduler.pop_due(START), (START, 'recording.mp4', 'recording', 500))
+
+        snapshot_time = START + timedelta(seconds=10)
+        scheduler.add(snapshot_time, 'snapshot.jpg', 'snapshot')
+        self.assertEqual(scheduler.pop_due(snapshot_time), (snapshot_time, 'snapshot.jpg', 'snapshot', 100))
+
+    def test_popped_snapshot_resets_the_gap(self):
+        scheduler = Scheduler(600)
+        scheduler.add(START, 'recording.mp4', 'recording', 500)
+        scheduler.add(START + timedelta(seconds=1), 'first.jpg', 'snapshot')
+        scheduler.pop_due(START + timedelta(seconds=1))
+        self.assertEqual(scheduler.pop_due(START + timedelta(seconds=1))[3], 100)
+
+        snapshot_time = START + timedelta(seconds=10)
+        scheduler.add(snapshot_time, 'second.jpg', 'snapshot')
+        self.assertEqual(scheduler.pop_due(snapshot_time)[3], 600)
+
+    def test_bulk_add_includes_popped_recordings(self):
+        scheduler = Scheduler(600)
+        scheduler.add(START, 'recording.mp4', 'recording', 200)
+        scheduler.pop_due(START)
+
+        scheduler.add_many([
+            (START + timedelta(seconds=5), 'first.jpg', 'snapshot', None),
+            (START + timedelta(seconds=6), 'second.jpg', 'snapshot', None),
+        ])
+        now = START + timedelta(seconds=6)
+        self.assertEqual(scheduler.pop_due(now)[3], 400)
+        self.assertEqual(scheduler.pop_due(now)[3], 600)
+
+    def test_updated_recording_duration_moves_to_next_snapshot(self):
+        scheduler = Scheduler(600)
+        scheduler.add(START, 'first.mp4', 'recording', 300)
+        scheduler.add(START + timedelta(seconds=1), 'second.mp4', 'recording', 200)
+        scheduler.add(START + timedelta(seconds=2), 'snapshot.jpg', 'snapshot')
+        scheduler.expect_update('first.mp4')
+        scheduler.expect_update('second.mp4')
+        scheduler.pop_due(START)
+        self.assertTrue(scheduler.update_duration('first.mp4', 100))
+        self.assertTrue(scheduler.update_duration('second.mp4', 50))
+
+        now = START + timedelta(seconds=2)
+        self.assertEqual(scheduler.pop_due(now)[3], 50)
+        self.assertEqual(scheduler.pop_due(now)[3], 450)
+
+    def test_only_recordings_awaiting_an_update_are_carried(self):
+        scheduler = Scheduler(600)
+        for second in range(3):
+            file_path = f'recording{second}.mp4'
+            scheduler.add(START + timedelta(seconds=second), file_path, 'recording', 10)
+            if second == 2:
+                scheduler.expect_update(file_path)
+        for _ in range(3):
+            scheduler.pop_due(START + timedelta(seconds=2))
+        self.assertEqual(scheduler.carried_recordings, {'recording2.mp4': 10})
+
+        scheduler.update_duration('recording2.mp4', 5)
+        self.assertEqual(scheduler.carried_recordings, {})
+        self.assertEqual(scheduler.awaiting_update, set())
+        self.assertEqual(scheduler.pending_gap, 25)
+
+    def test_recording_used_up_snapshot_is_dropped(self):
+        scheduler = Scheduler(600)
+        scheduler.add(START, 'recording.mp4', 'recording', 700)
+        scheduler.pop_due(START)
+        scheduler.add(START + timedelta(seconds=1), 'snapshot.jpg', 'snapshot')
+        self.assertIsNone(scheduler.pop_due(START + timedelta(seconds=1)))
+
+if __name__ == '__main__':
+    unittest.main()
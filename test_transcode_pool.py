@@ -0,0 +1,62 @@
+import threading
+import unittest
+from datetime import datetime, timedelta
+
+from transcode_pool import TranscodePool
+
+START = datetime(2024, 1, 1, 12, 0, 0)
+
+def wait_for(future):
+    future.result(timeout=5)
+    return future
+
+class TranscodePoolTest(unittest.TestCase):
+    def setUp(self):
+        self.pool = TranscodePool(2)
+        self.addCleanup(self.pool.shutdown)
+
+    def test_clips_are_released_in_scheduled_order(self):
+        first_may_finish = threading.Event()
+        first = self.pool.submit(START, first_may_finish.wait)
+        second = wait_for(self.pool.submit(START + timedelta(seconds=1), lambda: 'second'))
+
+        self.assertTrue(second.done())
+        self.assertEqual(self.pool.pop_finished(), [])
+
+        first_may_finish.set()
+        wait_for(first)
+        released = self.pool.pop_finished()
+        self.assertEqual([(scheduled_time, future.result()) for scheduled_time, future in released], [(START, True), (START + timedelta(seconds=1), 'second')])
+        self.assertEqual(self.pool.pending_count(), 0)
+
+    def test_finished_clips_are_held_until_their_time(self):
+        wait_for(self.pool.submit(START, lambda: 'first'))
+        wait_for(self.pool.submit(START + timedelta(minutes=5), lambda: 'second'))
+
+        self.assertEqual([future.result() for _, future in self.pool.pop_finished(START)], ['first'])
+        self.assertEqual(self.pool.next_release_time(), START + timedelta(minutes=5))
+        self.assertEqual(self.pool.pop_finished(START + timedelta(minutes=1)), [])
+        self.assertEqual([future.result() for _, future in self.pool.pop_finished(START + timedelta(minutes=5))], ['second'])
+        self.assertIsNone(self.pool.next_release_time())
+
+    def test_queued_jobs_run_earliest_deadline_first(self):
+        pool = TranscodePool(1)
+        self.addCleanup(pool.shutdown)
+        started = []
+        worker_busy = threading.Event()
+        may_continue = threading.Event()
+
+        def blocker():
+            worker_busy.set()
+            may_continue.wait()
+
+        pool.submit(START, blocker)
+        worker_busy.wait(timeout=5)
+        futures = [pool.submit(START + timedelta(seconds=seconds), started.append, seconds) for seconds in (30, 10, 20)]
+        may_continue.set()
+        for future in futures:
+            wait_for(future)
+        self.assertEqual(started, [10, 20, 30])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import heapq
+import itertools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+class TranscodePool:
+    def __init__(self, max_workers, on_finished=None, encode_slots=None):
+        self.on_finished = on_finished
+        self.encode_slots = encode_slots
+        self.max_workers = max(1, int(max_workers))
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='transcode')
+        self.pending = []
+        self.queued = []
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def run_with_slot(self, fn, *args):
+        # encode_slots is a semaphore shared with the other camera processes, so the total
+        # number of concurrent encodes on the machine stays bounded.
+        with self.encode_slots:
+            return fn(*args)
+
+    def run_next(self):
+        # Every submit queues one call of this, and each call runs whichever queued job has
+        # the earliest scheduled time, so free workers always pick the nearest deadline
+        # rather than the oldest submission.
+        with self.lock:
+            _, _, future, fn, args = heapq.heappop(self.queued)
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            if self.encode_slots is not None:
+                result = self.run_with_slot(fn, *args)
+            else:
+                result = fn(*args)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def submit(self, scheduled_time, fn, *args):
+        future = Future()
+        with self.lock:
+            order = next(self.counter)
+            heapq.heappush(self.queued, (scheduled_time, order, future, fn, args))
+            heapq.heappush(self.pending, (scheduled_time, order, future))
+        if self.on_finished is not None:
+            future.add_done_callback(lambda _: self.on_finished())
+        self.executor.submit(self.run_next)
+        return future
+
+    def pop_finished(self, now=None):
+        # Jobs finish in any order, but clips must reach the playlist in scheduled order,
+        # so only hand back the finished jobs at the head of the pending heap. With `now`,
+        # clips encoded ahead of time are also held until their scheduled time.
+        finished = []
+        with self.lock:
+            while self.pending and self.pending[0][2].done() and (now is None or self.pending[0][0] <= now):
+                scheduled_time, _, future = heapq.heappop(self.pending)
+                finished.append((scheduled_time, future))
+        return finished
+
+    def next_release_time(self):
+        # Scheduled time of the next finished clip that is being held, if any.
+        with self.lock:
+            if self.pending and self.pending[0][2].done():
+                return self.pending[0][0]
+        return None
+
+    def pending_count(self):
+        with self.lock:
+            return len(self.pending)
+
+    def shutdown(self, wait=True):
+        if not wait:
+            with self.lock:
+                for _, _, future, _, _ in self.queued:
+                    future.cancel()
+        self.executor.shutdown(wait=wait, cancel_futures=not wait)
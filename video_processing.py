@@ -1,76 +1,322 @@
 import os
 import subprocess
-    
-def create_video_from_snapshot(snapshot_path, duration, temp_directory):
+import threading
+from encoders import vaapi_backend
+
+OUTPUT_WIDTH = 1280
+OUTPUT_HEIGHT = 720
+OUTPUT_FRAME_RATE = '24/1'
+OUTPUT_GOP = 48
+OUTPUT_LEVEL = 40
+OUTPUT_SAMPLE_RATE = '16000'
+OUTPUT_CHANNELS = 1
+AUDIO_ENCODE_ARGS = ['-c:a', 'aac', '-b:a', '32k', '-ar', '16000', '-ac', '1']
+SNAPSHOT_LOOP_SECONDS = 2
+SILENT_AUDIO_FILENAME = f'silence_{SNAPSHOT_LOOP_SECONDS}s.m4a'
+MIN_CUT_SECONDS = 1
+LOG_MAX_BYTES = 5 * 1024 * 1024
+
+silent_audio_lock = threading.Lock()
+log_lock = threading.Lock()
+
+def run_ffmpeg(cmd, log_path, label):
+    # Several encodes run at once, so each job's output is collected and appended to the
+    # shared log in one piece under a header naming its output, instead of every job
+    # truncating the log. The log is rotated to `<log>.1` once it grows past LOG_MAX_BYTES.
+    result = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    with log_lock:
+        try:
+            if os.path.getsize(log_path) > LOG_MAX_BYTES:
+                os.replace(log_path, f'{log_path}.1')
+        except OSError:
+            pass
+        with open(log_path, 'a') as log_file:
+            log_file.write(f"===== {label} (exit code {result.returncode}) =====\n")
+            log_file.write(result.stdout.decode(errors='replace'))
+    if result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, cmd, result.stdout)
+
+def ensure_silent_audio(temp_directory):
+    # Every snapshot clip carries the same silent track, so it is encoded once and copied.
+    audio_path = os.path.join(temp_directory, SILENT_AUDIO_FILENAME)
+    with silent_audio_lock:
+        if not os.path.exists(audio_path):
+            temp_path = os.path.join(temp_directory, f'.{SILENT_AUDIO_FILENAME}')
+            cmd = [
+                'ffmpeg',
+                '-y',
+                '-f', 'lavfi',
+                '-i', 'anullsrc=channel_layout=mono:sample_rate=16000',
+                '-t', str(SNAPSHOT_LOOP_SECONDS),
+                *AUDIO_ENCODE_ARGS,
+                '-f', 'mp4',
+                temp_path
+            ]
+            run_ffmpeg(cmd, 'ffmpeg_snapshot_log.txt', SILENT_AUDIO_FILENAME)
+            os.replace(temp_path, audio_path)
+    return audio_path
+
+def partial_path(output_path):
+    # Encodes write to a hidden name next to the clip and are renamed into place when they
+    # finish, so an encode interrupted by a restart never leaves a partial clip behind.
+    directory, filename = os.path.split(output_path)
+    return os.path.join(directory, f'.{filename}')
+
+def is_video_compatible(video):
+    # The streaming server concatenates clips with `-c copy`, so a recording can only skip the
+    # video encode if it already looks like the stream produced by the transcode path.
+    return (
+        video is not None
+        and video.get('codec_name') == 'h264'
+        and video.get('profile') == 'High'
+        and 0 < video.get('level', 0) <= OUTPUT_LEVEL
+        and video.get('width') == OUTPUT_WIDTH
+        and video.get('height') == OUTPUT_HEIGHT
+        and video.get('pix_fmt') == 'yuv420p'
+        and video.get('r_frame_rate') == OUTPUT_FRAME_RATE
+        and video.get('has_b_frames', 0) == 0
+    )
+
+def is_audio_compatible(audio):
+    return (
+        audio is not None
+        and audio.get('codec_name') == 'aac'
+        and audio.get('sample_rate') == OUTPUT_SAMPLE_RATE
+        and audio.get('channels') == OUTPUT_CHANNELS
+    )
+
+def select_encode_mode(stream_info):
+    if not stream_info or not is_video_compatible(stream_info['video']):
+        return 'transcode'
+    if stream_info['max_gop'] is None or stream_info['max_gop'] > OUTPUT_GOP:
+        return 'transcode'
+    if is_audio_compatible(stream_info['audio']):
+        return 'copy'
+    return 'audio'
+
+def create_video_from_snapshot(snapshot_path, duration, temp_directory, encoder=None):
+    # Only one GOP of the still image is encoded; the playlist repeats the clip until
+    # `duration` is filled, so the encode cost does not depend on the duration.
     video_filename = os.path.basename(snapshot_path).replace('.jpg', '.mp4')
     output_path = os.path.join(temp_directory, video_filename)
     minutes, seconds = divmod(duration, 60)
+    audio_path = ensure_silent_audio(temp_directory)
+    encoder = encoder or vaapi_backend()
 
     print(f" --------- Processing file: {os.path.basename(snapshot_path)} ---------")
     
     cmd = [
         'ffmpeg',
+        '-y',
         # '-loglevel', 'debug',
-        '-vaapi_device', '/dev/dri/renderD128',
+        *encoder.input_args,
         '-loop', '1',
         '-framerate', '24',  
         '-i', snapshot_path,
-        '-f', 'lavfi',  
-        '-i', 'anullsrc=channel_layout=mono:sample_rate=16000',  
-        '-vf', 'format=nv12,hwupload,scale_vaapi=w=1280:h=720',
-        '-c:v', 'h264_vaapi',
-        '-profile:v', 'high', 
-        '-level', '40',  
+        '-i', audio_path,
+        *encoder.output_args(OUTPUT_WIDTH, OUTPUT_HEIGHT),
         '-r', '24', 
         '-g', '48', 
         '-bf', '0', 
         '-b:v', '2M',  
-        '-t', str(duration),
-        '-c:a', 'aac',  
-        '-b:a', '32k',  
-        '-ar', '16000',  
-        '-ac', '1',  
+        '-frames:v', str(SNAPSHOT_LOOP_SECONDS * 24),
+        '-c:a', 'copy',  
         '-shortest',  
         '-movflags', '+faststart', 
-        output_path
+        partial_path(output_path)
     ]
-    with open('ffmpeg_snapshot_log.txt', 'w') as log_file:
-        subprocess.run(cmd, check=True, stdout=log_file, stderr=log_file)
+    run_ffmpeg(cmd, 'ffmpeg_snapshot_log.txt', video_filename)
+    os.replace(partial_path(output_path), output_path)
 
-    print(f"  - Converted snapshot: {video_filename} with duration of {minutes} min {seconds} sec")
+    print(f"  - Converted snapshot: {video_filename} as a {SNAPSHOT_LOOP_SECONDS}s loop for a duration of {minutes} min {seconds} sec")
 
     return output_path 
 
-def reencode_video(recording_path, temp_directory, actual_duration):
+def create_videos_from_snapshots(snapshots, temp_directory, encoder=None):
+    # Encodes a burst of snapshots in one ffmpeg run, one output per snapshot, so the
+    # process start, device init and audio setup are paid once. Each output is the same
+    # 2 second loop create_video_from_snapshot makes; the per-snapshot duration is applied
+    # by the playlist.
+    audio_path = ensure_silent_audio(temp_directory)
+    encoder = encoder or vaapi_backend()
+    output_paths = [os.path.join(temp_directory, os.path.basename(snapshot_path).replace('.jpg', '.mp4')) for snapshot_path, _ in snapshots]
+
+    print(f" --------- Processing {len(snapshots)} snapshots in one batch ---------")
+
+    cmd = ['ffmpeg', '-y', *encoder.input_args]
+    for snapshot_path, _ in snapshots:
+        cmd += ['-loop', '1', '-framerate', '24', '-i', snapshot_path]
+    cmd += ['-i', audio_path]
+    for index, output_path in enumerate(output_paths):
+        cmd += [
+            '-map', f'{index}:v:0',
+            '-map', f'{len(snapshots)}:a:0',
+            *encoder.output_args(OUTPUT_WIDTH, OUTPUT_HEIGHT),
+            '-r', '24',
+            '-g', '48',
+            '-bf', '0',
+            '-b:v', '2M',
+            '-frames:v', str(SNAPSHOT_LOOP_SECONDS * 24),
+            '-c:a', 'copy',
+            '-shortest',
+            '-movflags', '+faststart',
+            partial_path(output_path)
+        ]
+    try:
+        run_ffmpeg(cmd, 'ffmpeg_snapshot_log.txt', ', '.join(os.path.basename(output_path) for output_path in output_paths))
+    except subprocess.CalledProcessError:
+        # The failed run has usually written every output already; clear them before the
+        # snapshots are encoded one by one.
+        for output_path in output_paths:
+            try:
+                os.remove(partial_path(output_path))
+            except FileNotFoundError:
+                pass
+        raise
+    for output_path in output_paths:
+        os.replace(partial_path(output_path), output_path)
+
+    for (snapshot_path, duration), output_path in zip(snapshots, output_paths):
+        minutes, seconds = divmod(duration, 60)
+        print(f"  - Converted snapshot: {os.path.basename(output_path)} as a {SNAPSHOT_LOOP_SECONDS}s loop for a duration of {minutes} min {seconds} sec")
+
+    return output_paths
+
+def keep_segments(duration, static_spans, hold_seconds):
+    # Cuts every static span down to its first `hold_seconds`, so a still scene is shown
+    # briefly instead of for its full length. Returns the (start, end) spans of the recording
+    # to keep, or None when nothing worth cutting was found.
+    segments = []
+    position = 0
+    for start, end in static_spans:
+        end = duration if end is None else min(end, duration)
+        cut_from = start + hold_seconds
+        if end - cut_from < MIN_CUT_SECONDS:
+            continue
+        if cut_from > position:
+            segments.append((position, cut_from))
+        position = end
+    if position == 0:
+        return None
+    if duration - position >= 0.01:
+        segments.append((position, duration))
+    if sum(end - start for start, end in segments) < MIN_CUT_SECONDS:
+        return None
+    return segments
+
+def trim_filter(segments, encoder, has_audio):
+    # trim/atrim each kept span, join them with concat and hand the result to the encoder's
+    # scaling filter, all in one filtergraph.
+    parts = []
+    inputs = ''
+    for index, (start, end) in enumerate(segments):
+        parts.append(f'[0:v:0]trim=start={start:.3f}:end={end:.3f},setpts=PTS-STARTPTS[v{index}]')
+        inputs += f'[v{index}]'
+        if has_audio:
+            parts.append(f'[0:a:0]atrim=start={start:.3f}:end={end:.3f},asetpts=PTS-STARTPTS[a{index}]')
+            inputs += f'[a{index}]'
+    audio_outputs = '[acat]' if has_audio else ''
+    parts.append(f'{inputs}concat=n={len(segments)}:v=1:a={1 if has_audio else 0}[vcat]{audio_outputs}')
+    parts.append(f'[vcat]{encoder.video_filter.format(width=OUTPUT_WIDTH, height=OUTPUT_HEIGHT)}[vout]')
+    return ';'.join(parts)
+
+def reencode_video(recording_path, temp_directory, actual_duration, stream_info=None, encoder=None, segments=None):
     video_filename = os.path.basename(recording_path)
     output_path = os.path.join(temp_directory, video_filename)
     minutes, seconds = divmod(actual_duration, 60)
+    # Trimming needs to know whether there is an audio track to cut, so a recording whose
+    # stream probe failed is encoded whole.
+    encode_mode = 'trim' if segments and stream_info else select_encode_mode(stream_info)
 
-    print(f" --------- Processing file: {video_filename} ---------")
+    print(f" --------- Processing file: {video_filename} ({encode_mode}) ---------")
 
-    cmd = [
-        'ffmpeg',
-        # '-loglevel', 'debug',
-        '-vaapi_device', '/dev/dri/renderD128',
-        '-i', recording_path,
-        '-vf', 'format=nv12,hwupload,scale_vaapi=w=1280:h=720',
-        '-c:v', 'h264_vaapi',
-        '-profile:v', 'high',
-        '-level', '40',  
-        '-r', '24',  
-        '-g', '48', 
-        '-bf', '0',  
-        '-b:v', '2M', 
-        '-c:a', 'aac',  
-        '-b:a', '32k',  
-        '-ar', '16000',  
-        '-ac', '1',  
-        '-movflags', '+faststart', 
-        output_path
-    ]
-    with open('ffmpeg_reencode_log.txt', 'w') as log_file:
-        subprocess.run(cmd, check=True, stdout=log_file, stderr=log_file)
+    if encode_mode == 'trim':
+        encoder = encoder or vaapi_backend()
+        has_audio = stream_info['audio'] is not None
+        cmd = [
+            'ffmpeg',
+            '-y',
+            *encoder.input_args,
+            '-i', recording_path,
+        ]
+        if not has_audio:
+            cmd += ['-f', 'lavfi', '-i', 'anullsrc=channel_layout=mono:sample_rate=16000']
+        cmd += [
+            '-filter_complex', trim_filter(segments, encoder, has_audio),
+            '-map', '[vout]',
+            '-map', '[acat]' if has_audio else '1:a:0',
+            '-c:v', encoder.codec,
+            *encoder.codec_args,
+            '-r', '24',
+            '-g', '48',
+            '-bf', '0',
+            '-b:v', '2M',
+            *AUDIO_ENCODE_ARGS,
+        ]
+        if not has_audio:
+            cmd.append('-shortest')
+        cmd += ['-movflags', '+faststart', partial_path(output_path)]
+    elif encode_mode == 'copy':
+        cmd = [
+            'ffmpeg',
+            '-y',
+            '-i', recording_path,
+            '-map', '0:v:0',
+            '-map', '0:a:0',
+            '-c', 'copy',
+            '-movflags', '+faststart',
+            partial_path(output_path)
+        ]
+    elif encode_mode == 'audio' and stream_info['audio'] is not None:
+        cmd = [
+            'ffmpeg',
+            '-y',
+            '-i', recording_path,
+            '-map', '0:v:0',
+            '-map', '0:a:0',
+            '-c:v', 'copy',
+            *AUDIO_ENCODE_ARGS,
+            '-movflags', '+faststart',
+            partial_path(output_path)
+        ]
+    elif encode_mode == 'audio':
+        cmd = [
+            'ffmpeg',
+            '-y',
+            '-i', recording_path,
+            '-f', 'lavfi',
+            '-i', 'anullsrc=channel_layout=mono:sample_rate=16000',
+            '-map', '0:v:0',
+            '-map', '1:a:0',
+            '-c:v', 'copy',
+            *AUDIO_ENCODE_ARGS,
+            '-shortest',
+            '-movflags', '+faststart',
+            partial_path(output_path)
+        ]
+    else:
+        encoder = encoder or vaapi_backend()
+        cmd = [
+            'ffmpeg',
+            '-y',
+            # '-loglevel', 'debug',
+            *encoder.input_args,
+            '-i', recording_path,
+            *encoder.output_args(OUTPUT_WIDTH, OUTPUT_HEIGHT),
+            '-r', '24',  
+            '-g', '48', 
+            '-bf', '0',  
+            '-b:v', '2M', 
+            '-c:a', 'aac',  
+            '-b:a', '32k',  
+            '-ar', '16000',  
+            '-ac', '1',  
+            '-movflags', '+faststart', 
+            partial_path(output_path)
+        ]
+    run_ffmpeg(cmd, 'ffmpeg_reencode_log.txt', video_filename)
+    os.replace(partial_path(output_path), output_path)
 
-    print(f"  - Re-encoded video: {video_filename} with duration of {minutes} min {seconds} sec")
+    print(f"  - Re-encoded video ({encode_mode}): {video_filename} with duration of {minutes} min {seconds} sec")
 
     return output_path